@@ -1,97 +1,424 @@
 # app.py (patched)
+import io
 import os
-import traceback
+import re
+import uuid
+import queue
+import tempfile
+import threading
+import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import ujson
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+from cache import VOLATILE_TTL, SemanticCache, SingleFlight, normalize_question
 
 st.set_page_config(page_title="AI Management Insight Bot", layout="wide")
 
+HISTORY_LIMIT = 50
+
+EXAMPLE_QUESTIONS: tuple = (
+    "เดือนนี้เราเสียโอกาสการขายไปเท่าไหร่?",
+    "ยอดขายสินค้ากลุ่ม X เทียบเดือนก่อนเป็นอย่างไร?",
+    "สัดส่วนการคืนสินค้าช่วง Q4 ของปีที่ผ่านมาเป็นอย่างไร?",
+)
+_EXAMPLE_SET = frozenset(EXAMPLE_QUESTIONS)
+# Sidebar radio labels, built once instead of via a format_func lambda on every rerun
+_EXAMPLE_LABELS = {q: q if len(q) <= 50 else q[:50] + "..." for q in EXAMPLE_QUESTIONS}
+
+# One scan classifies an error message: rate limit vs. DSPy LM configuration vs. other
+ERROR_CLASSIFIER = re.compile(
+    r"(?P<rate>429|rate.limit|quota)|(?P<lm>No LM is loaded|can only be changed by the thread)",
+    re.IGNORECASE,
+)
+
 def get_api_key():
+    """Memoized per session; a missing key is not memoized, so adding it later works without a restart."""
+    api_key = st.session_state.get("_api_key")
+    if api_key:
+        return api_key
     try:
         api_key = st.secrets.get("GEMINI_API_KEY")
     except Exception:
         api_key = None
     if not api_key:
         api_key = os.environ.get("GEMINI_API_KEY")
+    if api_key:
+        st.session_state["_api_key"] = api_key
     return api_key
 
+@st.cache_resource(show_spinner=False)
 def import_core():
+    """Import core (DSPy, DuckDB, pandas) once per process, on first use rather than on page render."""
+    # litellm otherwise downloads its model price map over HTTP while `import dspy` runs
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
     try:
-        from core import ask_bot_core
-        return ask_bot_core
+        return importlib.import_module("core")
     except Exception as e:
         raise RuntimeError(f"Error loading core module: {e}")
 
+@st.cache_resource(show_spinner=False)
+def _answer_cache():
+    return SemanticCache()
+
+@st.cache_resource(show_spinner=False)
+def _inflight():
+    return SingleFlight()
+
+# Status label shown once a streamed field arrives (i.e. what core is doing next)
+_STATUS_STEPS = {
+    "intent": "🗄️ กำลังรัน SQL...",
+    "table_view": "✍️ กำลังสร้าง Insight...",
+}
+
+@st.cache_resource(show_spinner=False)
+def _ask_pool():
+    """Threads that run core for a question, so a session rerun never interrupts a shared computation."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="ask")
+
+def _ask_and_cache(core, question, updates):
+    """
+    Run core for one question (no st.* calls: the result is shared with other sessions via SingleFlight).
+    Partial results go to `updates`; a successful answer is cached even if the asking session has moved on.
+    """
+    result = {}
+    for field, value in core.ask_bot_core_stream(question):
+        result[field] = value
+        updates.put(dict(result))
+    if not result.get("sql_error"):
+        _answer_cache().put(question, result)
+    return result
+
+def cached_ask_bot(core, question, on_update=None):
+    """
+    Serve paraphrased repeats from the semantic cache; only successful answers are stored.
+    Identical questions submitted concurrently by other sessions share one ask_bot_core call, run on
+    _ask_pool. The session that started it gets on_update(partial_result) as each field streams in
+    from core; the others just wait for the finished result.
+    """
+    cache = _answer_cache()
+    result = cache.get(question)
+    if result is not None:
+        return result
+    updates = queue.Queue()
+    future = _ask_pool().submit(_inflight().do, normalize_question(question), _ask_and_cache, core, question, updates)
+    while True:
+        try:
+            partial = updates.get(timeout=0.05)
+        except queue.Empty:
+            if future.done() and updates.empty():
+                break
+            continue
+        if on_update is not None:
+            on_update(partial)
+    return future.result()
+
+# Stand-in cached for an example whose pipeline raised, so it is not retried on every rerun
+_EXAMPLE_FAILED = {
+    "intent": "",
+    "sql": "",
+    "table_view": "",
+    "kpi_summary": "",
+    "explanation": "ตอบคำถามตัวอย่างนี้ไม่สำเร็จ",
+    "action": "ลองใหม่อีกครั้งในอีกสักครู่",
+    "sql_error": True,
+    "sql_error_message": "Example question failed",
+    "sql_error_available_tables": [],
+}
+
+def _warm_examples(core, missing):
+    """
+    Answer sidebar examples the answer cache does not have, in parallel with one ask_bot_batch call
+    shared by concurrent sessions. Successful answers expire with ttl_for like any other answer; failures
+    are cached too, for VOLATILE_TTL, so a failing example is not re-planned on every rerun.
+    """
+    cache = _answer_cache()
+    results = _inflight().do("\0examples\0" + "\0".join(missing), core.ask_bot_batch, missing)
+    answers = {}
+    for q, r in zip(missing, results):
+        if not isinstance(r, dict):
+            r = {"question": q, **_EXAMPLE_FAILED}
+        cache.put(q, r, ttl=VOLATILE_TTL if r.get("sql_error") else None)
+        answers[q] = r
+    return answers
+
+def _history_path():
+    """Per-browser history file; the id lives in the URL (?sid=...) so it survives a page refresh."""
+    sid = st.query_params.get("sid", "")
+    if not re.fullmatch(r"[0-9a-f]{32}", sid):
+        sid = uuid.uuid4().hex
+        st.query_params["sid"] = sid
+    return os.path.join(tempfile.gettempdir(), f"history_{sid}.jsonl")
+
+def _load_history():
+    """
+    Last HISTORY_LIMIT records of the JSON Lines history file; deque(maxlen) drops older lines
+    while reading. The file is compacted here, once per session, so appends stay O(1).
+    """
+    path = _history_path()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        history = deque(map(ujson.loads, lines), maxlen=HISTORY_LIMIT)
+    except (FileNotFoundError, ValueError):
+        return deque(maxlen=HISTORY_LIMIT)
+    if len(lines) > HISTORY_LIMIT:
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                f.writelines(ujson.dumps(item, ensure_ascii=False) + "\n" for item in history)
+        except OSError:
+            pass
+    return history
+
+def append_history(question, result):
+    """Keep only what render_history shows (no DataFrames) so the records stay JSON-serializable."""
+    item = {
+        "question": question,
+        "result": {"intent": result.get("intent", ""), "sql": result.get("sql", "")},
+    }
+    st.session_state.history.append(item)
+    try:
+        with open(_history_path(), "a", encoding="utf-8") as f:
+            f.write(ujson.dumps(item, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+def _warm_up():
+    """Background: import core and warm it up (DB, planner, LM connection) while the user is still typing."""
+    try:
+        core = import_core()
+        core.warm_up()
+        st.session_state.lm_initialized = True
+    except Exception:
+        # the submit path reports real failures; warm-up is best-effort
+        pass
+
 def initialize_session():
     if "lm_initialized" not in st.session_state:
         st.session_state.lm_initialized = False
     if "history" not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = _load_history()
     if "prefill" not in st.session_state:
         st.session_state.prefill = ""
-    if "running" not in st.session_state:
-        st.session_state.running = False  # prevent double submit
+    if "last_result" not in st.session_state:
+        st.session_state.last_result = None
+    if "last_error" not in st.session_state:
+        st.session_state.last_error = None
+    if "submit_lock" not in st.session_state:
+        st.session_state.submit_lock = threading.Lock()  # prevent double submit
+
+def start_warm_up():
+    """Once per session, after GEMINI_API_KEY is in the environment (the warm-up pings the LM with it)."""
+    if "warmup_started" not in st.session_state:
+        st.session_state.warmup_started = True
+        t = threading.Thread(target=_warm_up, daemon=True)
+        add_script_run_ctx(t)
+        t.start()
+
+def _use_example():
+    st.session_state.prefill = st.session_state.example_choice
+
+# Static sidebar text, sent as one element instead of one per line
+_SIDEBAR_FOOTER = "---\n\nหากเจอปัญหา: Refresh (F5) หรือ Reboot app ใน Streamlit Cloud\n\n---"
 
 def sidebar_ui():
     with st.sidebar:
         st.title("🔧 Controls")
         st.markdown("### ตัวอย่างคำถาม")
-        examples = [
-            "เดือนนี้เราเสียโอกาสการขายไปเท่าไหร่?",
-            "ยอดขายสินค้ากลุ่ม X เทียบเดือนก่อนเป็นอย่างไร?",
-            "สัดส่วนการคืนสินค้าช่วง Q4 ของปีที่ผ่านมาเป็นอย่างไร?",
-        ]
-        for i, ex in enumerate(examples):
-            if st.button(ex, key=f"example_{i}"):
-                st.session_state.prefill = ex
-
-        st.markdown("---")
-        st.markdown("### Troubleshooting")
-        st.markdown("**Status:**")
-        st.markdown(f"- LM Initialized: {'✅' if st.session_state.lm_initialized else '⏳'}")
-        st.markdown("---")
-        st.markdown("หากเจอปัญหา: Refresh (F5) หรือ Reboot app ใน Streamlit Cloud")
-        st.markdown("---")
+        # One form = one rerun when the user confirms, not one per button click
+        with st.form("examples", clear_on_submit=False):
+            st.radio(
+                "ตัวอย่าง",
+                EXAMPLE_QUESTIONS,
+                format_func=_EXAMPLE_LABELS.__getitem__,
+                key="example_choice",
+                label_visibility="collapsed",
+            )
+            st.form_submit_button("ใช้คำถามนี้", on_click=_use_example)
+        st.toggle("▶️ รันคำถามตัวอย่างทั้งหมด", key="show_examples")
+
+        cache = _answer_cache()
+        st.markdown(
+            "---\n\n### Troubleshooting\n**Status:**\n"
+            f"- LM Initialized: {'✅' if st.session_state.lm_initialized else '⏳'}\n"
+            f"- Answer cache: {len(cache)} entries, {cache.hits} hits / {cache.misses} misses"
+        )
+        st.markdown(_SIDEBAR_FOOTER)
         st.caption("เวอร์ชัน: 1.0")
 
+# Which render_result section a streamed field belongs to
+_SECTION_OF = {
+    "question": "head", "intent": "head", "sql": "head",
+    "table": "table", "table_view": "table",
+    "kpi_summary": "tail", "explanation": "tail", "action": "tail",
+}
+
+def result_slots():
+    """One st.empty() per render_result section, so a streamed field only redraws its own section."""
+    return {section: st.empty() for section in ("head", "table", "tail")}
+
+def render_result(result, slots=None, pending="⏳ ...", only=None):
+    """
+    Render the result panel as three elements (text / table / text) instead of six subheader/body pairs.
+    The table goes through st.dataframe (Arrow) when core returned one. Sections missing from a
+    partially streamed result show `pending`; `slots` comes from result_slots() and `only` limits
+    the redraw to one section (e.g. "tail" once the table is already on screen).
+    """
+    slots = slots or result_slots()
+    if only in (None, "head"):
+        head = io.StringIO()
+        head.write(f"### 🎯 Intent ที่ระบบตีความ\n{result.get('intent', pending) or '(none)'}\n\n")
+        head.write(f"### 📜 SQL ที่ใช้จริง\n```sql\n{result.get('sql', '')}\n```\n\n")
+        head.write("### 📊 ผลลัพธ์ดิบจาก Datamart\n")
+        slots["head"].markdown(head.getvalue())
+
+    if only in (None, "table"):
+        table = result.get("table")
+        if table is not None and not table.empty:
+            slots["table"].dataframe(table, use_container_width=True, hide_index=True)
+        else:
+            slots["table"].markdown(result.get("table_view", pending))
+
+    if only in (None, "tail"):
+        tail = io.StringIO()
+        tail.write(f"### 📌 KPI Summary\n{result.get('kpi_summary', pending)}\n\n")
+        tail.write(f"### 🧠 Explanation (มุมมองผู้บริหาร)\n{result.get('explanation', pending)}\n\n")
+        tail.write(f"### 🚀 Suggested Actions\n{result.get('action', pending)}\n")
+        slots["tail"].markdown(tail.getvalue())
+
+def render_sql_error(result):
+    """Structured SQL error returned from core (planner gave no SQL, unknown table, or DuckDB failure)."""
+    st.error("⚠️ เกิดข้อผิดพลาดในการรัน SQL")
+    st.warning(result.get("sql_error_message", "SQL execution failed"))
+    with st.expander("🔍 รายละเอียด SQL และคำแนะนำ"):
+        # one markdown element (fenced SQL keeps highlighting) instead of one per line / table name
+        body = io.StringIO()
+        body.write(f"**SQL ที่ส่งไป:**\n```sql\n{result.get('sql', '')}\n```\n\n")
+        available = result.get("sql_error_available_tables", [])
+        if available:
+            body.write("**ตารางที่มีในฐานข้อมูล (ตัวอย่าง):**\n")
+            body.write("".join(f"- {t}\n" for t in available))
+        else:
+            body.write("ไม่พบตารางในฐานข้อมูล หรือไม่สามารถดึงรายการตารางได้\n")
+        body.write("\n---\n\n**แนะนำ:** ตรวจสอบชื่อตาราง/คอลัมน์ในคำถาม หรือปรับคำถามให้ใช้ตารางที่มีอยู่")
+        st.markdown(body.getvalue())
+    st.markdown(
+        f"### 🧾 รายละเอียดจากระบบ\n{result.get('explanation', '')}\n\n{result.get('action', '')}"
+    )
+
+def _render_traceback(exc):
+    """Format the traceback only when asked for; format_exception walks every DSPy/litellm frame."""
+    if st.toggle("แสดง Traceback", key="show_traceback"):
+        import traceback
+
+        st.code("".join(traceback.format_exception(exc)))
+
+def render_error(exc, replay=False):
+    """
+    Classify an exception raised by core (LM config / rate limit / other) and show guidance.
+    replay=True re-draws a stored error on a later rerun without repeating its side effects.
+    """
+    error_msg = str(exc)
+    m = ERROR_CLASSIFIER.search(error_msg)
+    kind = m.lastgroup if m else "other"
+    if isinstance(exc, AssertionError):
+        if kind == "lm":
+            if not replay:
+                try:
+                    st.cache_resource.clear()
+                except Exception:
+                    pass
+
+            st.error("⚠️ **DSPy Configuration Error**")
+            st.warning("🔄 Cache cleared automatically. กรุณา Refresh หน้าเว็บ (F5) แล้วลองอีกครั้ง")
+            with st.expander("🔍 Technical Details"):
+                st.code(f"Error: {error_msg}")
+                st.markdown("""
+**สาเหตุ:** LM configuration failed (อาจเกิดจาก rate limit หรือ race condition)
+
+**วิธีแก้:**
+1. Refresh หน้าเว็บ (กด F5)
+2. รอ 1-2 นาที ถ้าเป็น rate limit
+3. ลองถามคำถามอีกครั้ง
+""")
+        else:
+            st.error(f"AssertionError: {error_msg}")
+            with st.expander("🔍 Debug"):
+                _render_traceback(exc)
+    elif kind == "rate":
+        st.error("⚠️ **API Rate Limit Error**")
+        st.warning("Gemini API อาจถูกจำกัด ขอแนะนำให้รอสักครู่ก่อนใช้งานอีกครั้ง")
+        with st.expander("🔍 รายละเอียด"):
+            st.markdown(f"**Error:** {error_msg}")
+            st.markdown("""
+**แนวทางแก้ไข**
+- รอสัก 1-2 นาที แล้วลองใหม่
+- อย่ากดส่งซ้ำเร็วเกินไป
+- พิจารณาเพิ่ม tier API ถ้าจำเป็น
+""")
+    else:
+        st.error("⚠️ **An unexpected error occurred**")
+        with st.expander("🔍 Debug Information"):
+            _render_traceback(exc)
+
 def render_history():
+    """Newest first, as one dataframe widget instead of three elements per entry."""
     if st.session_state.history:
         with st.expander("ประวัติการถาม-ตอบ (History)", expanded=False):
-            for i, item in enumerate(reversed(st.session_state.history[-50:])):
-                q = item.get("question")
-                res = item.get("result", {})
-                st.markdown(f"**Q:** {q}")
-                if res:
-                    intent = res.get("intent", "")
-                    sql = res.get("sql", "")
-                    st.write(f"- Intent: {intent}")
-                    if sql:
-                        st.code(sql, language="sql")
-                st.markdown("---")
-
-def main():
-    initialize_session()
-
-    api_key = get_api_key()
-    if not api_key:
-        st.title("📊 AI Management Insight Chatbot")
-        st.caption("ถามเหมือนผู้บริหาร → แปลเป็น SQL → สรุป Insight จาก iPhone Gold Datamart")
-        st.error("⚠️ **GEMINI_API_KEY not found!**")
-        st.info("Please add your Gemini API key in Streamlit Cloud Settings → Secrets or set the GEMINI_API_KEY environment variable")
-        st.code('GEMINI_API_KEY = "your-api-key-here"', language="toml")
-        st.stop()
+            st.dataframe(
+                [
+                    {
+                        "Q": item.get("question", ""),
+                        "Intent": item.get("result", {}).get("intent", ""),
+                        "SQL": item.get("result", {}).get("sql", ""),
+                    }
+                    for item in reversed(st.session_state.history)
+                ],
+                use_container_width=True,
+                hide_index=True,
+            )
 
+def render_example_tabs():
+    """All sidebar examples in tabs: cached answers show at once, the rest fill in after one parallel batch."""
     try:
-        ask_bot_core = import_core()
+        core = import_core()
     except RuntimeError as e:
         st.error("⚠️ **Error loading core module**")
         st.info(str(e))
-        st.stop()
-
-    sidebar_ui()
+        return
+    tabs = dict(zip(EXAMPLE_QUESTIONS, st.tabs(list(_EXAMPLE_LABELS.values()))))
+    cache = _answer_cache()
+    missing = []
+    for q, tab in tabs.items():
+        with tab:
+            st.markdown(f"**Q:** {q}")
+            result = cache.get(q)
+            if result is None:
+                missing.append(q)
+            else:
+                _render_answer(result)
+    if not missing:
+        return
+    with st.spinner("กำลังเตรียมคำตอบของคำถามตัวอย่าง..."):
+        answers = _warm_examples(core, missing)
+    for q in missing:
+        with tabs[q]:
+            _render_answer(answers[q])
 
-    st.title("📊 AI Management Insight Chatbot")
-    st.caption("ถามเหมือนผู้บริหาร → แปลเป็น SQL → สรุป Insight จาก iPhone Gold Datamart")
+def _render_answer(result):
+    if result.get("sql_error"):
+        render_sql_error(result)
+    else:
+        render_result(result)
 
+@st.fragment
+def render_main_panel():
+    """
+    Ask form + answer + history. Submitting the form reruns only this fragment, and the
+    last answer is kept in session_state so it stays visible across unrelated reruns.
+    """
     # Use a form so changing inputs doesn't trigger reruns immediately
     with st.form("ask_form"):
         question = st.text_input(
@@ -100,115 +427,105 @@ def main():
             placeholder="เช่น เดือนนี้เราเสียโอกาสการขายไปเท่าไหร่? หรือ เดือน 11 ปี 2025 ยอดขายเปลี่ยนแปลงอย่างไร?"
         )
         submit = st.form_submit_button("🔍 วิเคราะห์เลย")
-    # Prevent double-submit: if already running, ignore further submits
-    if submit and st.session_state.running:
+    # Prevent double-submit: a check-then-set flag lets two fast reruns both pass, a non-blocking acquire doesn't
+    if submit and not st.session_state.submit_lock.acquire(blocking=False):
         st.warning("กำลังประมวลผลคำถามก่อนหน้า กรุณารอ...")
         submit = False
 
     if submit:
-        if not question or not question.strip():
-            st.error("กรุณาพิมพ์คำถามก่อนกด วิเคราะห์เลย")
-        else:
-            st.session_state.prefill = ""
-            st.session_state.running = True
-            try:
-                with st.spinner("กำลังวาง SQL และสร้าง Insight..."):
-                    result = ask_bot_core(question)
+        try:
+            if not question or not question.strip():
+                st.error("กรุณาพิมพ์คำถามก่อนกด วิเคราะห์เลย")
+            else:
+                try:
+                    core = import_core()
+                except RuntimeError as e:
+                    st.error("⚠️ **Error loading core module**")
+                    st.info(str(e))
+                    st.stop()
+
+                st.session_state.prefill = ""
+                st.session_state.last_error = None
+                try:
+                    status = st.status("🧠 กำลังวาง SQL...", expanded=False)
+                    live = result_slots()
+                    render_result({}, live)
+
+                    def _progress(partial):
+                        field = next(reversed(partial))
+                        step = _STATUS_STEPS.get(field)
+                        if step:
+                            status.update(label=step)
+                        section = _SECTION_OF.get(field)
+                        if section:
+                            render_result(partial, live, only=section)
 
-                    # Handle structured SQL error returned from core
-                    if isinstance(result, dict) and result.get("sql_error"):
-                        st.error("⚠️ เกิดข้อผิดพลาดในการรัน SQL")
-                        st.warning(result.get("sql_error_message", "SQL execution failed"))
-                        with st.expander("🔍 รายละเอียด SQL และคำแนะนำ"):
-                            st.markdown("**SQL ที่ส่งไป:**")
-                            st.code(result.get("sql", ""), language="sql")
-                            available = result.get("sql_error_available_tables", [])
-                            if available:
-                                st.markdown("**ตารางที่มีในฐานข้อมูล (ตัวอย่าง):**")
-                                for t in available:
-                                    st.write(f"- {t}")
-                            else:
-                                st.markdown("ไม่พบตารางในฐานข้อมูล หรือไม่สามารถดึงรายการตารางได้")
-                            st.markdown("---")
-                            st.markdown("**แนะนำ:** ตรวจสอบชื่อตาราง/คอลัมน์ในคำถาม หรือปรับคำถามให้ใช้ตารางที่มีอยู่")
-                        st.subheader("🧾 รายละเอียดจากระบบ")
-                        st.write(result.get("explanation", ""))
-                        st.write(result.get("action", ""))
-                        # Save to history
-                        st.session_state.history.append({"question": question, "result": result})
-                        continue
-
-                    # Normal successful flow
-                    st.session_state.lm_initialized = True
-                    st.session_state.history.append({"question": question, "result": result})
-
-                    st.subheader("🎯 Intent ที่ระบบตีความ")
-                    st.write(result.get("intent", "(none)"))
-
-                    st.subheader("📜 SQL ที่ใช้จริง")
-                    st.code(result.get("sql", ""), language="sql")
-
-                    st.subheader("📊 ผลลัพธ์ดิบจาก Datamart")
-                    st.markdown(result.get("table_view", ""))
-
-                    st.subheader("📌 KPI Summary")
-                    st.write(result.get("kpi_summary", ""))
-
-                    st.subheader("🧠 Explanation (มุมมองผู้บริหาร)")
-                    st.write(result.get("explanation", ""))
-
-                    st.subheader("🚀 Suggested Actions")
-                    st.write(result.get("action", ""))
-
-            except AssertionError as ae:
-                error_msg = str(ae)
-                if "No LM is loaded" in error_msg or "can only be changed by the thread" in error_msg:
                     try:
-                        st.cache_resource.clear()
+                        if question in _EXAMPLE_SET:
+                            # first pick answers every example in parallel; cached_ask_bot then reads
+                            # this question's answer (or cached failure) from the answer cache
+                            missing = [q for q in EXAMPLE_QUESTIONS if _answer_cache().peek(q) is None]
+                            if missing:
+                                _warm_examples(core, missing)
+                        result = cached_ask_bot(core, question, on_update=_progress)
                     except Exception:
-                        pass
+                        status.update(label="❌ เกิดข้อผิดพลาด", state="error")
+                        raise
+                    status.update(label="✅ เสร็จ", state="complete")
 
-                    st.error("⚠️ **DSPy Configuration Error**")
-                    st.warning("🔄 Cache cleared automatically. กรุณา Refresh หน้าเว็บ (F5) แล้วลองอีกครั้ง")
-                    with st.expander("🔍 Technical Details"):
-                        st.code(f"Error: {error_msg}")
-                        st.markdown("""
-**สาเหตุ:** LM configuration failed (อาจเกิดจาก rate limit หรือ race condition)
+                    # Save to history (structured SQL errors included)
+                    st.session_state.last_result = result
+                    append_history(question, result)
+                    if isinstance(result, dict) and result.get("sql_error"):
+                        for slot in live.values():
+                            slot.empty()
+                        render_sql_error(result)
+                    else:
+                        st.session_state.lm_initialized = True
+                        render_result(result, live)
 
-**วิธีแก้:**
-1. Refresh หน้าเว็บ (กด F5)
-2. รอ 1-2 นาที ถ้าเป็น rate limit
-3. ลองถามคำถามอีกครั้ง
-""")
-                else:
-                    st.error(f"AssertionError: {error_msg}")
-                    with st.expander("🔍 Debug"):
-                        st.code(traceback.format_exc())
-
-            except Exception as e:
-                error_msg = str(e)
-                if "429" in error_msg or "rate limit" in error_msg.lower() or "quota" in error_msg.lower():
-                    st.error("⚠️ **API Rate Limit Error**")
-                    st.warning("Gemini API อาจถูกจำกัด ขอแนะนำให้รอสักครู่ก่อนใช้งานอีกครั้ง")
-                    with st.expander("🔍 รายละเอียด"):
-                        st.markdown(f"**Error:** {error_msg}")
-                        st.markdown("""
-**แนวทางแก้ไข**
-- รอสัก 1-2 นาที แล้วลองใหม่
-- อย่ากดส่งซ้ำเร็วเกินไป
-- พิจารณาเพิ่ม tier API ถ้าจำเป็น
-""")
-                else:
-                    st.error("⚠️ **An unexpected error occurred**")
-                    with st.expander("🔍 Debug Information"):
-                        st.code(traceback.format_exc())
-            finally:
-                st.session_state.running = False
+                except Exception as e:
+                    # kept so the traceback toggle (a fragment rerun) can show it again
+                    st.session_state.last_error = e
+                    render_error(e)
+        finally:
+            st.session_state.submit_lock.release()
 
+    elif st.session_state.last_error is not None:
+        render_error(st.session_state.last_error, replay=True)
+    elif st.session_state.last_result is not None:
+        if st.session_state.last_result.get("sql_error"):
+            render_sql_error(st.session_state.last_result)
+        else:
+            render_result(st.session_state.last_result)
     else:
         st.info("ลองพิมพ์คำถามด้านบน แล้วกดปุ่ม 🔍 วิเคราะห์เลย")
 
     render_history()
 
+def main():
+    initialize_session()
+
+    api_key = get_api_key()
+    if not api_key:
+        st.title("📊 AI Management Insight Chatbot")
+        st.caption("ถามเหมือนผู้บริหาร → แปลเป็น SQL → สรุป Insight จาก iPhone Gold Datamart")
+        st.error("⚠️ **GEMINI_API_KEY not found!**")
+        st.info("Please add your Gemini API key in Streamlit Cloud Settings → Secrets or set the GEMINI_API_KEY environment variable")
+        st.code('GEMINI_API_KEY = "your-api-key-here"', language="toml")
+        st.stop()
+    # litellm reads the key from the environment when core's LM makes a call
+    os.environ["GEMINI_API_KEY"] = api_key
+    start_warm_up()
+
+    sidebar_ui()
+
+    st.title("📊 AI Management Insight Chatbot")
+    st.caption("ถามเหมือนผู้บริหาร → แปลเป็น SQL → สรุป Insight จาก iPhone Gold Datamart")
+
+    if st.session_state.get("show_examples"):
+        render_example_tabs()
+    render_main_panel()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,260 @@
+# cache.py
+# Near-duplicate question cache for ask_bot_core results (persisted to /tmp)
+
+import os
+import math
+import re
+import time
+import pickle
+import logging
+import tempfile
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import CancelledError, Future
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# ---------- CONFIG ----------
+CACHE_PATH = os.path.join(tempfile.gettempdir(), "semcache.pkl")
+SIMILARITY_CUTOFF = 0.93  # n-gram cosine paraphrase threshold (1.0 = exact match only)
+MAX_ENTRIES = 500  # least-recently-used entries beyond this are evicted
+DEFAULT_TTL = 3600  # seconds
+VOLATILE_TTL = 300  # questions about "now" (เดือนนี้ / วันนี้ / ตอนนี้)
+HISTORICAL_TTL = 7 * 86400  # questions pinned to a past year never change
+
+logger = logging.getLogger("madt_core")
+
+# ---------- Helpers ----------
+# Thai digits -> ASCII, full-width "?" -> "?", zero-width spaces/joiners dropped (one C-level pass)
+_NORMALIZE = str.maketrans("๐๑๒๓๔๕๖๗๘๙？", "0123456789?", "\u200b\u200c\u200d\ufeff")
+
+def normalize_question(question: str) -> str:
+    """
+    Map trivially different inputs onto one key: NFC-normalize Thai combining marks,
+    fold Thai digits / full-width '?', strip zero-width characters, collapse whitespace, casefold
+    (so "iPhone" and "iphone" match).
+    """
+    return unicodedata.normalize("NFC", " ".join(question.translate(_NORMALIZE).split())).casefold()
+
+NGRAM_SIZES = (2, 3)
+
+def ngram_vector(text: str) -> Dict[str, float]:
+    """
+    Cheap sparse "embedding": L2-normalized character 2/3-gram counts of normalize_question(text).
+    Character n-grams work on unsegmented Thai without a tokenizer or model download.
+    """
+    t = normalize_question(text)
+    counts = Counter(t[i:i + n] for n in NGRAM_SIZES for i in range(len(t) - n + 1))
+    norm = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+    return {g: c / norm for g, c in counts.items()}
+
+def cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    """Cosine similarity of two ngram_vector() results (both already unit length)."""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(g, 0.0) for g, v in a.items())
+
+_NUMBER_RE = re.compile(r"\d+")
+# Words that change the answer while barely changing the n-grams: ranking direction, iPhone model tier,
+# and what the result is broken down by. Compared as a set, so "สูงสุด" and "สูงที่สุด" still match.
+_KEY_TERM_RE = re.compile(
+    r"(?:สูง|ต่ำ|มาก|น้อย|ดี|แย่)(?:ที่)?สุด"
+    r"|\b(?:top|bottom|highest|lowest|best|worst|most|least)\b"
+    r"|\bpro\s*max\b|\b(?:pro|plus|mini|max)\b"
+    r"|สาขา|รุ่น|จังหวัด|ความจุ|แต่ละสี|ตามสี|รายวัน|รายสัปดาห์|รายเดือน"
+)
+
+def key_terms(text: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    (numbers, key words) of normalize_question(text), both sorted. Two questions can only share an
+    answer when these are equal, however similar the rest of the wording is.
+    """
+    t = normalize_question(text)
+    words = {re.sub(r"\s+|ที่", "", m.group()) for m in _KEY_TERM_RE.finditer(t)}
+    return tuple(sorted(_NUMBER_RE.findall(t))), tuple(sorted(words))
+
+_VOLATILE_RE = re.compile(r"เดือนนี้|วันนี้|ตอนนี้")
+_YEAR_RE = re.compile(r"ปี\s*(\d{4})")
+
+def ttl_for(question: str) -> int:
+    """Pick a TTL from how time-sensitive the question is (Thai digits and Buddhist-era years included)."""
+    text = normalize_question(question)
+    if _VOLATILE_RE.search(text):
+        return VOLATILE_TTL
+    m = _YEAR_RE.search(text)
+    if m:
+        year = int(m.group(1))
+        if year > 2400:
+            year -= 543  # Buddhist era: 2567 = 2024
+        if year < datetime.now().year:
+            return HISTORICAL_TTL
+    return DEFAULT_TTL
+
+# ---------- Cache ----------
+class SemanticCache:
+    """
+    Question -> result cache that also hits on near-duplicate phrasings (cosine of character n-gram
+    vectors, only between questions with the same key_terms: numbers, ranking direction, model tier, breakdown).
+    Entries expire after ttl_for(question) seconds, at most `max_entries` are kept (LRU),
+    and they are pickled to `path` on every write so they survive Streamlit reruns and process restarts.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, cutoff: float = SIMILARITY_CUTOFF, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.cutoff = cutoff
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # serializes file writes, which happen outside _lock
+        self._version = 0  # bumped on every put; a writer holding an older snapshot skips the write
+        self._saved_version = 0
+        # normalized question -> (result, expires_at); dict order doubles as LRU order
+        self._entries: Dict[str, Tuple[Any, float]] = {}
+        # normalized question -> (ngram_vector, key_terms), rebuilt from _entries rather than persisted
+        self._vectors: Dict[str, Tuple[Dict[str, float], Tuple[Tuple[str, ...], Tuple[str, ...]]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def get(self, question: str) -> Optional[Any]:
+        """Return the cached result of the most similar fresh question, or None."""
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit and hit[1] > now:
+                self.hits += 1
+                self._entries[key] = self._entries.pop(key)
+                return hit[0]
+            probe = ngram_vector(key)
+            terms = key_terms(key)
+            best, best_key, best_score = None, None, self.cutoff
+            for cached_q, (result, expires_at) in self._entries.items():
+                if expires_at <= now:
+                    continue
+                vector, cached_terms = self._vectors[cached_q]
+                # dates / models / ranking direction / breakdown differ -> a different answer
+                if cached_terms != terms:
+                    continue
+                score = cosine(probe, vector)
+                if score >= best_score:
+                    best, best_key, best_score = result, cached_q, score
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[best_key] = self._entries.pop(best_key)
+            return best
+
+    def peek(self, question: str) -> Optional[Any]:
+        """Fresh result stored under exactly this (normalized) question; not counted in hits/misses."""
+        with self._lock:
+            hit = self._entries.get(normalize_question(question))
+        return hit[0] if hit and hit[1] > time.time() else None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, question: str, result: Any, ttl: Optional[int] = None) -> None:
+        key = normalize_question(question)
+        ttl = ttl_for(question) if ttl is None else ttl
+        now = time.time()
+        with self._lock:
+            self._entries = {q: e for q, e in self._entries.items() if e[1] > now}
+            self._entries.pop(key, None)
+            self._entries[key] = (result, now + ttl)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._reindex()
+            self._version += 1
+            snapshot = (self._version, dict(self._entries))
+        self._save(*snapshot)
+
+    def _reindex(self) -> None:
+        """Keep _vectors in step with _entries, vectorizing only questions not seen before."""
+        old = self._vectors
+        self._vectors = {
+            q: old[q] if q in old else (ngram_vector(q), key_terms(q)) for q in self._entries
+        }
+
+    def _load(self) -> None:
+        """Best-effort reload of entries persisted by a previous process."""
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)
+            now = time.time()
+            self._entries = {q: e for q, e in entries.items() if e[1] > now}
+            self._reindex()
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning("Ignoring unreadable cache file: %s", self.path)
+
+    def _save(self, version: int, entries: Dict[str, Tuple[Any, float]]) -> None:
+        """
+        Pickle a snapshot of the entries without holding _lock, so readers are not blocked on the write.
+        Result DataFrames ("table") stay in memory only; a reloaded answer renders from its table_view.
+        """
+        with self._save_lock:
+            if version <= self._saved_version:
+                return
+            payload = {
+                q: ({k: v for k, v in result.items() if k != "table"} if isinstance(result, dict) else result, expires_at)
+                for q, (result, expires_at) in entries.items()
+            }
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(payload, f)
+                os.replace(tmp, self.path)
+                self._saved_version = version
+            except Exception:
+                logger.exception("Failed to persist cache to %s", self.path)
+
+# ---------- In-flight dedup ----------
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one computation:
+    the first caller runs fn, later callers block on the same Future.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        fn(*args), shared with concurrent callers of the same key. An Exception reaches every caller;
+        a BaseException (KeyboardInterrupt, Streamlit's rerun/stop control flow) stays in the leader's
+        thread, and followers retry as if the call had never started.
+        """
+        while True:
+            with self._lock:
+                fut = self._inflight.get(key)
+                leader = fut is None
+                if leader:
+                    fut = Future()
+                    self._inflight[key] = fut
+            if leader:
+                break
+            try:
+                return fut.result()
+            except CancelledError:
+                continue
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._drop(key)
+            fut.set_exception(e)
+            raise
+        except BaseException:
+            self._drop(key)
+            fut.cancel()
+            raise
+        self._drop(key)
+        fut.set_result(result)
+        return result
+
+    def _drop(self, key: str) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
@@ -2,7 +2,7 @@
 compile_app.py (v2.0.9)
 =======================
 Streamlit app สำหรับ compile planner online ผ่าน Streamlit Cloud
-รองรับ 13 examples ทั้งหมด + config ที่เหมาะสม
+รวม labeled examples จาก trainset.py เป็น optimized_planner.json (ไม่เรียก LM)
 
 วิธีใช้:
 1. Deploy ไฟล์นี้เป็น Streamlit app ชั่วคราว
@@ -14,61 +14,51 @@ Streamlit app สำหรับ compile planner online ผ่าน Streamlit C
 
 import streamlit as st
 import os
+from pathlib import Path
 
 st.set_page_config(page_title="DSPy Planner Compiler", layout="wide")
 
 st.title("🔨 DSPy Planner Compiler v2.0.9")
-st.caption("Compile optimized planner online - รองรับ 13 examples ทั้งหมด")
+st.caption("Compile optimized planner online - labeled demos จาก trainset.py (ไม่เรียก API)")
 
-# ============================================
-# CHECK API KEY
-# ============================================
-
-if "GEMINI_API_KEY" not in st.secrets and "GEMINI_API_KEY" not in os.environ:
-    st.error("⚠️ **GEMINI_API_KEY not found!**")
-    st.info("Please add your Gemini API key in Streamlit Cloud Settings → Secrets")
-    st.code('GEMINI_API_KEY = "your-api-key-here"', language="toml")
-    st.stop()
-
-# Set from secrets
-if "GEMINI_API_KEY" in st.secrets:
-    os.environ["GEMINI_API_KEY"] = st.secrets["GEMINI_API_KEY"]
-
-st.success("✅ GEMINI_API_KEY found")
-
-# Import after API key is set
+# Compiling makes no LM calls, so no GEMINI_API_KEY is needed
+# (bundled litellm price map: skip its HTTP fetch when core imports dspy)
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
 try:
-    import dspy
-    from dspy import InputField, OutputField
-    from dspy.teleprompt import BootstrapFewShot
-    import json
+    import ujson
 except ImportError as e:
     st.error(f"❌ Missing dependencies: {e}")
-    st.info("Make sure requirements.txt includes: dspy-ai==2.5.36")
+    st.info("Make sure requirements.txt is installed")
     st.stop()
 
 # ============================================
 # IMPORT FROM CORE.PY
 # ============================================
 
-st.info("📚 Loading training examples from core.py...")
+st.info("📚 Loading training examples from trainset.py...")
+
+@st.cache_resource
+def _get_trainset():
+    """dspy.Example may not pickle (st.cache_data), so share the list as a resource across reruns."""
+    from trainset import trainset
+    return trainset
 
 try:
     # Import everything from core.py
     from core import (
-        IntentAndSQL,
-        SQLPlanner, 
-        trainset,
-        ex1, ex2, ex3, ex4, ex5, ex6, ex7, ex8, ex9,
-        ex10, ex11, ex12, ex13
+        ANCHOR_DEMOS,
+        KNN_DEMOS,
+        PLANNER_HASH_PATH,
+        compile_planner,
+        save_planner,
     )
+    trainset = _get_trainset()
     
     st.success(f"✅ Loaded {len(trainset)} training examples")
     
-    # Show examples
+    # Show examples (one markdown element, not one per example)
     with st.expander("👁️ View Training Examples"):
-        for i, ex in enumerate(trainset, 1):
-            st.write(f"**ex{i}:** {ex.question[:60]}...")
+        st.markdown("\n".join(f"- **ex{i}:** {ex.question[:60]}..." for i, ex in enumerate(trainset, 1)))
     
 except ImportError as e:
     st.error(f"❌ Cannot import from core.py: {e}")
@@ -86,53 +76,31 @@ col1, col2, col3 = st.columns(3)
 with col1:
     st.metric("Examples", len(trainset))
 with col2:
-    st.metric("Temperature", "0.1")
+    st.metric("LM Calls", "0")
 with col3:
-    st.metric("Max Tokens", "2000")
+    st.metric("Demos per Question", ANCHOR_DEMOS + KNN_DEMOS)
 
 st.markdown("---")
 
 if st.button("🔨 Compile Planner Now", type="primary", use_container_width=True):
     
-    with st.spinner("🔄 Compiling planner (this may take 2-3 minutes)..."):
+    with st.spinner("🔄 Compiling planner..."):
         
         try:
-            # Configure DSPy
             progress = st.progress(0)
             status = st.empty()
             
-            status.write("⚙️ Step 1/4: Configuring DSPy LM...")
-            lm = dspy.LM(
-                "gemini/gemini-2.5-flash",
-                max_tokens=2000,      # ✅ For complex SQL
-                temperature=0.1,      # ✅ For consistent output  
-                top_p=0.95
-            )
-            dspy.configure(lm=lm)
-            progress.progress(25)
-            
-            # Create planner
-            status.write("🏗️ Step 2/4: Creating base planner...")
-            base_planner = SQLPlanner()
-            progress.progress(50)
-            
             # Compile
-            status.write("🔨 Step 3/4: Compiling with BootstrapFewShot...")
-            status.caption("⏰ This will use ~10-15 API calls and take 1-2 minutes...")
+            status.write("🔨 Step 1/2: Compiling planner from labeled demos...")
             
-            teleprompter = BootstrapFewShot(
-                metric=lambda ex, pred, trace=None: 0.0,
-                max_bootstrapped_demos=5,  # Keep top 5 examples
-                max_labeled_demos=5
-            )
-            
-            optimized_planner = teleprompter.compile(base_planner, trainset=trainset)
-            progress.progress(75)
+            # Same config core uses when the JSON is missing/stale (labeled demos only, no LM calls)
+            optimized_planner = compile_planner()
+            progress.progress(50)
             
             # Save to temp file
-            status.write("💾 Step 4/4: Saving compiled planner...")
+            status.write("💾 Step 2/2: Saving compiled planner...")
             output_file = "optimized_planner.json"
-            optimized_planner.save(output_file)
+            save_planner(optimized_planner, output_file)  # + optimized_planner.sha1 (trainset hash)
             progress.progress(100)
             
             status.empty()
@@ -145,8 +113,7 @@ if st.button("🔨 Compile Planner Now", type="primary", use_container_width=Tru
             st.markdown("---")
             st.subheader("📥 Download Compiled File")
             
-            with open(output_file, "r") as f:
-                file_content = f.read()
+            file_content = Path(output_file).read_text()
             
             st.download_button(
                 label="⬇️ Download optimized_planner.json",
@@ -156,11 +123,19 @@ if st.button("🔨 Compile Planner Now", type="primary", use_container_width=Tru
                 type="primary",
                 use_container_width=True
             )
+            st.download_button(
+                label="⬇️ Download optimized_planner.sha1",
+                data=Path(PLANNER_HASH_PATH).read_text(),
+                file_name=PLANNER_HASH_PATH,
+                mime="text/plain",
+                use_container_width=True
+            )
             
             # Show file info
             file_size = len(file_content)
-            parsed_json = json.loads(file_content)
-            num_demos = len(parsed_json.get("predict.predict", {}).get("demos", []))
+            parsed_json = ujson.loads(file_content)
+            demos = parsed_json.get("predict", {}).get("demos", [])
+            num_demos = len(demos)
             
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -182,23 +157,18 @@ if st.button("🔨 Compile Planner Now", type="primary", use_container_width=Tru
             
             1. **Add optimized_planner.json to your repo:**
                ```bash
-               git add optimized_planner.json
-               git commit -m "Add pre-compiled planner with 13 examples"
+               git add optimized_planner.json optimized_planner.sha1
+               git commit -m "Recompile planner from trainset.py"
                git push
                ```
             
-            2. **Update core.py to use the JSON:**
-               - เปลี่ยน `get_optimized_planner()` ให้โหลด JSON
-               - หรือใช้ version ที่มี JSON loading แล้ว
-            
-            3. **Deploy main app (app.py)**
+            2. **Deploy main app (app.py)**
                - จะโหลด planner จาก JSON ทันที
                - ไม่ต้อง compile อีก
             
-            4. **ผลลัพธ์:**
-               - ✅ Token savings: ~100-200 per session
+            3. **ผลลัพธ์:**
                - ✅ Faster startup: No compilation needed
-               - ✅ All 13 examples included
+               - ✅ All trainset.py examples included
             
             **หมายเหตุ:**
             - ไฟล์นี้ใช้ได้ตลอด
@@ -208,12 +178,11 @@ if st.button("🔨 Compile Planner Now", type="primary", use_container_width=Tru
             
             # Show preview
             with st.expander("👁️ Preview File Content"):
-                st.json(parsed_json)
+                st.json(parsed_json, expanded=False)
             
             # Show which examples were selected
             if num_demos > 0:
                 with st.expander("🎯 Selected Examples (Demos)"):
-                    demos = parsed_json.get("predict.predict", {}).get("demos", [])
                     for i, demo in enumerate(demos, 1):
                         st.write(f"**Demo {i}:** {demo.get('question', 'N/A')[:80]}...")
             
@@ -228,21 +197,9 @@ if st.button("🔨 Compile Planner Now", type="primary", use_container_width=Tru
             st.markdown("""
             **Common Issues:**
             
-            1. **Rate Limit Error (429):**
-               - Wait 1-2 minutes
-               - Try again
-            
-            2. **JSONAdapter Error:**
-               - This is expected during compilation
-               - BootstrapFewShot will retry automatically
-            
-            3. **Import Error:**
-               - Make sure core.py is in same directory
+            1. **Import Error:**
+               - Make sure core.py and trainset.py are in same directory
                - Check requirements.txt has all dependencies
-            
-            4. **API Key Error:**
-               - Verify GEMINI_API_KEY in Streamlit secrets
-               - Make sure it's valid and active
             """)
 
 else:
@@ -250,41 +207,27 @@ else:
     ### 📝 Instructions
     
     1. กดปุ่ม **"🔨 Compile Planner Now"** ด้านบน
-    2. รอ 2-3 นาที (ระหว่างที่ compile)
+    2. รอไม่กี่วินาที (ไม่เรียก API)
     3. กด **"⬇️ Download optimized_planner.json"**
     4. Commit ไฟล์นั้นเข้า repo หลัก
     5. Deploy app.py ตามปกติ
     
     ### ⚡ What This Does
     
-    - Loads all **13 training examples** from core.py
-    - Runs **BootstrapFewShot** to select best 5 examples
-    - Optimizes prompts for better accuracy
-    - Saves result to downloadable JSON file
-    - Uses **optimized LM config** (temp=0.1, max_tokens=2000)
-    
-    ### 🎯 Expected Performance
-    
-    **Before (Simple Mode):**
-    - Token usage: ~350-450 per session
-    - All 13 examples loaded every time
-    
-    **After (With Optimized JSON):**
-    - Token usage: ~260 per session ⚡
-    - Only 5 best examples loaded
-    - **Savings: ~100-200 tokens per session!**
+    - Loads the labeled **training examples** from trainset.py
+    - Keeps them as the planner's demos (no bootstrapping, no LM calls)
+    - Saves result to downloadable JSON file (+ trainset hash in optimized_planner.sha1)
+    - At question time core sends the anchor demos plus the most similar ones
     
-    ### 💰 Cost Savings
+    ### 🎯 Why Commit the JSON
     
-    For 100 sessions/day:
-    - Savings: ~10,000-20,000 tokens/day
-    - = ~$0.10-$0.20/day
-    - = **~$3-6/month** 💰
+    - app.py loads the planner from optimized_planner.json at startup
+    - optimized_planner.sha1 tells core whether the JSON still matches trainset.py;
+      a stale or missing JSON is recompiled in memory on every cold start
     """)
 
 # Show current status
 st.sidebar.header("📊 Status")
-st.sidebar.write("✅ API Key configured")
 st.sidebar.write(f"✅ Trainset loaded ({len(trainset)} examples)")
 st.sidebar.write("✅ Core.py imported successfully")
 st.sidebar.write("⏳ Ready to compile")
@@ -292,8 +235,8 @@ st.sidebar.write("⏳ Ready to compile")
 st.sidebar.markdown("---")
 st.sidebar.markdown("### 💡 Tips")
 st.sidebar.markdown("""
-- Compilation ใช้เวลา 2-3 นาที
-- ใช้ ~10-15 API calls (~$0.01)
+- Compilation ใช้เวลาไม่กี่วินาที
+- ไม่เรียก API (ใช้ labeled demos จาก trainset)
 - ทำครั้งเดียว ใช้ได้ตลอด
 - เก็บไฟล์ไว้ใน repo
 - Compile ใหม่เมื่อ update trainset
@@ -302,4 +245,3 @@ st.sidebar.markdown("""
 st.sidebar.markdown("---")
 st.sidebar.markdown("### 📌 Version")
 st.sidebar.code("v2.0.9")
-st.sidebar.caption("With JSONAdapter fix")
@@ -2,21 +2,41 @@
 # Minimal hotfix: lazy DB init, SQL pre-validation, structured SQL error handling
 
 import os
+import asyncio
+import atexit
 import re
 import time
+import hashlib
 import logging
-from typing import List, Optional, Dict, Any, Tuple
+import tempfile
+import functools
+import threading
+from datetime import date
+from decimal import Decimal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Tuple, Iterator, Union
 
-import duckdb
-import pandas as pd
+# duckdb / pandas are imported where they are used (see get_connection / run_sql)
+if TYPE_CHECKING:
+    import duckdb
+    import pandas as pd
+
+# DSPy reads these at import: keep its litellm disk cache of LM responses in /tmp (writable on
+# Streamlit Cloud), capped well below the 30 GB default
+os.environ.setdefault("DSPY_CACHEDIR", os.path.join(tempfile.gettempdir(), "dspy_cache"))
+os.environ.setdefault("DSPY_CACHE_LIMIT", str(500 * 1024 * 1024))
+
+from cache import SemanticCache, cosine, key_terms, ngram_vector, normalize_question
 
 # DSPy imports left as-is (assuming dspy present)
 import dspy
 from dspy import InputField, OutputField
 
+from trainset import trainset  # labeled examples (single source for compile_app.py too)
+
 # ---------- CONFIG ----------
 DB_PATH = "iphone_gold.duckdb"
-AUTO_REPAIR_CUTOFF = 0.88  # conservative threshold for auto-repair (not used in minimal hotfix)
 
 # ---------- Logger ----------
 logger = logging.getLogger("madt_core")
@@ -36,38 +56,162 @@ class SQLExecutionError(Exception):
         self.original_exception = original_exception
         self.available_tables = available_tables or []
 
+# ---------- Connection ----------
+_CON_LOCK = threading.Lock()
+_CON = None
+
+def get_connection() -> "duckdb.DuckDBPyConnection":
+    """
+    Process-wide read-only connection to DB_PATH, opened on first use (after ensure_database_exists).
+    Queries run on their own .cursor(), which is safe to use from concurrent Streamlit sessions.
+    """
+    global _CON
+    with _CON_LOCK:
+        if _CON is None:
+            import duckdb
+
+            _CON = duckdb.connect(DB_PATH, read_only=True, config={"memory_limit": "512MB"})
+            atexit.register(_CON.close)
+        return _CON
+
+def _close_connection() -> None:
+    global _CON
+    with _CON_LOCK:
+        if _CON is not None:
+            _CON.close()
+            _CON = None
+
+def _cursor(db_path: str) -> "duckdb.DuckDBPyConnection":
+    if db_path == DB_PATH:
+        return get_connection().cursor()
+    import duckdb
+
+    return duckdb.connect(db_path, read_only=True)
+
 # ---------- Helpers ----------
 def _list_tables(db_path: str = DB_PATH) -> List[str]:
     """Return list of tables in the DuckDB file (best-effort)."""
     try:
-        con = duckdb.connect(db_path, read_only=True)
-        rows = con.execute("SHOW TABLES").fetchall()
-        con.close()
-        return [r[0] for r in rows]
+        con = _cursor(db_path)
+        try:
+            return [r[0] for r in con.execute("SHOW TABLES").fetchall()]
+        finally:
+            con.close()
     except Exception:
         return []
 
+# opening fence (with optional language tag), body, optional closing fence
+_FENCED_RE = re.compile(r"\A```[a-zA-Z0-9_]*\n?(.*?)(?:```)?\Z", re.DOTALL)
+
 def clean_sql(sql: str) -> str:
     """clean code fences from LLM output"""
     if not isinstance(sql, str):
         return sql
     s = sql.strip()
-    if s.startswith("```"):
-        s = re.sub(r"^```[a-zA-Z0-9_]*\n?", "", s)
-        if s.endswith("```"):
-            s = s[:-3]
-    return s.strip()
-
-def run_sql(sql: str, db_path: str = DB_PATH) -> Tuple[pd.DataFrame, str]:
-    """Run SQL and return (DataFrame, markdown table). Raise SQLExecutionError on failure."""
+    if "```" not in s:
+        return s
+    m = _FENCED_RE.match(s)
+    return (m.group(1) if m else s).strip()
+
+TABLE_VIEW_ROWS = 20  # rows carried by the markdown view; the UI shows the full DataFrame
+MAX_RESULT_ROWS = 10_000  # rows fetched from DuckDB at most; caps memory for unbounded ad-hoc queries
+RESULT_BATCH_ROWS = 2048
+
+def _cell(value: Any) -> str:
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+def _markdown_table(df: "pd.DataFrame", max_rows: int = TABLE_VIEW_ROWS) -> str:
+    """Pipe table of the first max_rows rows, floats rounded to 2 places (no tabulate round-trip)."""
+    head = df.head(max_rows).round(2)
+    lines = [
+        "| " + " | ".join(map(_cell, head.columns)) + " |",
+        "|" + "---|" * len(head.columns),
+    ]
+    lines.extend("| " + " | ".join(map(_cell, row)) + " |" for row in head.itertuples(index=False, name=None))
+    if len(df) > max_rows:
+        lines.append(f"\n*(แสดง {max_rows} จาก {len(df)} แถว)*")
+    return "\n".join(lines)
+
+SQL_CACHE_SIZE = 128  # (df, table_view) results kept per process
+_SQL_CACHE: "OrderedDict[Tuple[str, str, Tuple[Any, ...]], Tuple[pd.DataFrame, str]]" = OrderedDict()
+_SQL_CACHE_MTIME: Dict[str, float] = {}
+_SQL_CACHE_LOCK = threading.Lock()
+
+# SQL whose result depends on when it runs ("เดือนนี้" / "วันนี้" plans); never served from _SQL_CACHE
+_VOLATILE_SQL_RE = re.compile(
+    r"\b(?:current_date|current_time|current_timestamp|localtime|localtimestamp|get_current_\w+"
+    r"|(?:now|today|random|uuid|gen_random_uuid)\s*\()",
+    re.IGNORECASE,
+)
+
+def _sql_cache_get(key: Tuple[str, str, Tuple[Any, ...]]) -> Optional[Tuple["pd.DataFrame", str]]:
+    """Cached result for key, or None; the whole cache is dropped when the DB file's mtime changes."""
+    db_path = key[0]
+    try:
+        mtime = os.path.getmtime(db_path)
+    except OSError:
+        return None
+    with _SQL_CACHE_LOCK:
+        if _SQL_CACHE_MTIME.get(db_path) != mtime:
+            for k in [k for k in _SQL_CACHE if k[0] == db_path]:
+                del _SQL_CACHE[k]
+            _SQL_CACHE_MTIME[db_path] = mtime
+            return None
+        hit = _SQL_CACHE.get(key)
+        if hit is not None:
+            _SQL_CACHE.move_to_end(key)
+        return hit
+
+def _sql_cache_put(key: Tuple[str, str, Tuple[Any, ...]], value: Tuple["pd.DataFrame", str]) -> None:
+    with _SQL_CACHE_LOCK:
+        _SQL_CACHE[key] = value
+        _SQL_CACHE.move_to_end(key)
+        while len(_SQL_CACHE) > SQL_CACHE_SIZE:
+            _SQL_CACHE.popitem(last=False)
+
+def run_sql(
+    sql: str, db_path: str = DB_PATH, params: Optional[Union[List[Any], Dict[str, Any]]] = None
+) -> Tuple["pd.DataFrame", str]:
+    """
+    Run SQL and return (DataFrame, markdown table). Raise SQLExecutionError on failure.
+    `params` are bound to `?` placeholders (a list) or `$name` ones (a dict, e.g. a template's date_key)
+    instead of being spliced into the SQL text.
+    Results are cached per (db_path, sql, params) until the DB file changes, except for SQL reading the
+    clock (CURRENT_DATE, now(), ...); treat the DataFrame as read-only.
+    Columns are Arrow-backed (pd.ArrowDtype): strings stay in Arrow buffers instead of Python objects.
+    Record batches are pulled only until MAX_RESULT_ROWS rows; the rest of the result is never fetched.
+    """
+    import duckdb
+    import pandas as pd
+    import pyarrow as pa
+
+    key = (db_path, sql, tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params or ()))
+    cacheable = not _VOLATILE_SQL_RE.search(sql)
+    hit = _sql_cache_get(key) if cacheable else None
+    if hit is not None:
+        return hit
     try:
-        con = duckdb.connect(db_path, read_only=True)
-        df = con.execute(sql).df()
-        con.close()
+        con = _cursor(db_path)
+        try:
+            reader = con.execute(sql, params).fetch_record_batch(RESULT_BATCH_ROWS)
+            batches, fetched = [], 0
+            for batch in reader:
+                batches.append(batch)
+                fetched += batch.num_rows
+                if fetched > MAX_RESULT_ROWS:
+                    break
+            table = pa.Table.from_batches(batches, schema=reader.schema).slice(0, MAX_RESULT_ROWS)
+            df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        finally:
+            con.close()
         if df.empty:
             table_view = "*(no rows)*"
         else:
-            table_view = df.to_markdown(index=False)
+            table_view = _markdown_table(df)
+            if fetched > MAX_RESULT_ROWS:
+                table_view += f"\n\n*(ผลลัพธ์ถูกตัดไว้ที่ {MAX_RESULT_ROWS:,} แถวแรก)*"
+        if cacheable:
+            _sql_cache_put(key, (df, table_view))
         return df, table_view
     except duckdb.CatalogException as ce:
         available = _list_tables(db_path)
@@ -77,68 +221,358 @@ def run_sql(sql: str, db_path: str = DB_PATH) -> Tuple[pd.DataFrame, str]:
 
 # ---------- DSPy signatures (unchanged for now) ----------
 class IntentAndSQL(dspy.Signature):
+    """Convert a top-management business question into DuckDB SQL using the iPhone Gold Datamart.
+
+    Rules:
+    - ใช้เฉพาะตาราง:
+      fact_registration(date_key, branch_id, product_id, reg_count)
+      fact_contract(date_key, branch_id, product_id, contract_count)
+      fact_inventory_snapshot(date_key, branch_id, product_id, stock_qty)
+      dim_date(date_key, date, year, month, day)
+      dim_product(product_id, model_name, generation, storage_gb, color, base_price)
+      dim_branch(branch_id, branch_code, branch_name, branch_type, province, is_active)
+    - ตารางกว้าง (JOIN dim_* ไว้แล้ว ใช้แทนการ JOIN ได้): fact_contract_wide, fact_registration_wide, fact_inventory_wide
+      = คอลัมน์ของ fact + date, year, month, day, branch_code, branch_name, branch_type, province,
+        model_name, generation, storage_gb, color, base_price
+
+    - วันที่: date_key = INT YYYYMMDD
+    - กรองทั้งเดือน/ช่วงวันด้วย date_key ของ fact ตรงๆ (เช่น date_key >= 20251101 AND date_key < 20251201)
+      ไม่ต้อง JOIN dim_date ถ้าไม่ได้ SELECT คอลัมน์ของมัน
+    - Revenue = SUM(c.contract_count * p.base_price) ถ้าถามยอดขายเป็นเงิน
+    - ใช้ province ไม่ใช่ region สำหรับ dim_branch
+    """
+
     question: str = InputField()
     intent: str = OutputField()
     sql: str = OutputField()
 
+ANCHOR_DEMOS = 2  # fixed demos sent with every question
+KNN_DEMOS = 2  # plus the compiled demos most similar to the question
+
+@functools.lru_cache(maxsize=256)
+def _question_vector(text: str) -> Dict[str, float]:
+    return ngram_vector(text)
+
 class SQLPlanner(dspy.Module):
     def __init__(self):
         super().__init__()
         self.predict = dspy.ChainOfThought(IntentAndSQL)
 
     def forward(self, question: str):
-        return self.predict(question=question)
+        return self.predict(question=question, demos=self.select_demos(question))
+
+    def select_demos(self, question: str) -> list:
+        """
+        The first ANCHOR_DEMOS compiled demos, then the KNN_DEMOS others closest to the question
+        (character n-gram cosine), instead of every compiled demo on every call.
+        Everything is sent in compiled order, so the prompt always opens with the same system message
+        and anchor demos, and questions picking the same neighbours share an even longer prefix
+        (Gemini's implicit context cache bills a repeated prefix at the cached rate).
+        """
+        demos = self.predict.predictors()[0].demos
+        if len(demos) <= ANCHOR_DEMOS + KNN_DEMOS:
+            return demos
+        q = _question_vector(question)
+        nearest = sorted(
+            range(ANCHOR_DEMOS, len(demos)),
+            key=lambda i: cosine(q, _question_vector(demos[i]["question"])),
+            reverse=True,
+        )[:KNN_DEMOS]
+        return demos[:ANCHOR_DEMOS] + [demos[i] for i in sorted(nearest)]
+
+class InsightFromResult(dspy.Signature):
+    """Summarize a DuckDB query result for top management, in Thai: KPIs, what they mean, what to do next."""
+
+    question: str = InputField()
+    table_json: str = InputField(desc="SQL result as compact JSON: {columns, data}, plus total_rows and column_sums when data holds only the first rows")
+    kpi_summary: str = OutputField(desc="at most 3 short bullets of the key numbers")
+    explanation: str = OutputField(desc="1-2 sentences")
+    action: str = OutputField(desc="at most 2 short bullets")
+
+# ---------- Template shortcut ----------
+TEMPLATE_CUTOFF = 0.97  # n-gram cosine to a trainset question above which its SQL is reused (with equal key_terms)
+_THAI_MONTHS = (
+    "มกราคม", "กุมภาพันธ์", "มีนาคม", "เมษายน", "พฤษภาคม", "มิถุนายน",
+    "กรกฎาคม", "สิงหาคม", "กันยายน", "ตุลาคม", "พฤศจิกายน", "ธันวาคม",
+)
+_THAI_MONTH_ABBRS = ("ม.ค", "ก.พ", "มี.ค", "เม.ย", "พ.ค", "มิ.ย", "ก.ค", "ส.ค", "ก.ย", "ต.ค", "พ.ย", "ธ.ค")
+_MONTH_NUMBERS = {
+    **{name: i for i, name in enumerate(_THAI_MONTHS, 1)},
+    **{abbr: i for i, abbr in enumerate(_THAI_MONTH_ABBRS, 1)},
+}
+_DAY_RE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")
+_MONTH_RES = (
+    re.compile(r"เดือน\s*(\d{1,2})\s*(?:ปี\s*)?(\d{4})"),  # เดือน 11 ปี 2025
+    re.compile(r"(?:เดือน\s*)?(\d{1,2})/(\d{4})"),  # 11/2025
+    re.compile(  # (เดือน)พฤศจิกายน 2025 / พ.ย. 2568 (4-digit years only)
+        r"(?:เดือน\s*)?("
+        + "|".join(_THAI_MONTHS + tuple(re.escape(a) for a in _THAI_MONTH_ABBRS))
+        + r")\.?\s*(?:ปี\s*)?(\d{4})"
+    ),
+)
+
+def _year(text: str) -> int:
+    year = int(text)
+    return year - 543 if year > 2400 else year  # Buddhist-era years (2568 = 2025)
+
+def parse_date_filter(question: str) -> Tuple[Dict[str, int], str]:
+    """
+    The first single day ({date_key}) or month ({year, month}) the question names, plus the question
+    with that date replaced by a placeholder. ({}, question) when there is none or it is not a real date.
+    """
+    text = normalize_question(question)
+    m = _DAY_RE.search(text)
+    if m:
+        day, month, year = int(m.group(1)), int(m.group(2)), _year(m.group(3))
+        try:
+            date(year, month, day)
+        except ValueError:
+            return {}, text
+        return {"date_key": year * 10000 + month * 100 + day}, text[:m.start()] + "{date}" + text[m.end():]
+    matches = [m for m in (r.search(text) for r in _MONTH_RES) if m]
+    if matches:
+        m = min(matches, key=lambda m: m.start())
+        name = m.group(1)
+        month = _MONTH_NUMBERS[name] if name in _MONTH_NUMBERS else int(name)
+        if not 1 <= month <= 12:
+            return {}, text
+        return {"year": _year(m.group(2)), "month": month}, text[:m.start()] + "{month}" + text[m.end():]
+    return {}, text
+
+def _date_params(date_filter: Dict[str, int]) -> Dict[str, int]:
+    """date_filter plus, for a month, the date_key range [month_start, next_month_start)."""
+    if "month" not in date_filter:
+        return dict(date_filter)
+    year, month = date_filter["year"], date_filter["month"]
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return {
+        **date_filter,
+        "month_start": year * 10000 + month * 100 + 1,
+        "next_month_start": next_year * 10000 + next_month * 100 + 1,
+    }
+
+def _sql_template(ex: dspy.Example, date_filter: Dict[str, int]) -> Optional[str]:
+    """
+    ex.sql with the question's date literals turned into DuckDB named parameters $date_key /
+    $month_start / $next_month_start (or $year / $month in `year = ...` / `month = ...` filters),
+    or None when that does not account for every use of them (e.g. `d.month IN (10, 11)`).
+    """
+    if not date_filter:
+        return None
+    params = _date_params(date_filter)
+    sql = ex.sql
+    for name in ("date_key", "month_start", "next_month_start"):
+        if name in params:
+            sql = re.sub(rf"\b{params[name]}\b", "$" + name, sql)
+    for name in ("year", "month"):
+        if name in params:
+            sql = re.sub(rf"(\b{name}\s*=\s*){params[name]}\b", r"\g<1>$" + name, sql)
+    if sql == ex.sql or any(re.search(rf"\b{value}\b", sql) for value in params.values()):
+        return None
+    return sql
+
+@functools.lru_cache(maxsize=1)
+def _templates() -> List[Tuple[dspy.Example, Optional[str], str, frozenset, Tuple[Tuple[str, ...], Tuple[str, ...]]]]:
+    """
+    (example, sql template, question to match against, date filter keys, its key_terms) per trainset example.
+    Examples whose date cannot be lifted out of their SQL (e.g. a two-month comparison) keep a None
+    template and only match questions naming the same numbers.
+    """
+    templates = []
+    for ex in trainset:
+        date_filter, masked = parse_date_filter(ex.question)
+        sql = _sql_template(ex, date_filter)
+        if sql is None:
+            text, keys = normalize_question(ex.question), frozenset()
+        else:
+            text, keys = masked, frozenset(date_filter)
+        templates.append((ex, sql, text, keys, key_terms(text)))
+    return templates
+
+def match_template(question: str) -> Optional[dspy.Prediction]:
+    """
+    Plan (intent, sql, params) from the trainset example this question is a rewording of, or None.
+    Examples whose SQL filters on a single day/month are parameterized, so the same wording about
+    another date reuses the labeled SQL with the date bound as query parameters (params).
+    A reused plan answers without the LM, so matching is strict: the same numbers and key words
+    (ranking direction, model tier, breakdown) as the example, and near-identical wording otherwise.
+    """
+    date_filter, masked = parse_date_filter(question)
+    plain = normalize_question(question)
+    best, best_score = None, TEMPLATE_CUTOFF
+    for ex, sql, ex_text, keys, ex_terms in _templates():
+        if sql is None:
+            text = plain
+        elif keys == set(date_filter):
+            text = masked  # same kind of date: compare the wording around it
+        else:
+            continue
+        if key_terms(text) != ex_terms:
+            continue
+        score = cosine(_question_vector(text), _question_vector(ex_text))
+        if score >= best_score:
+            best, best_score = (ex, sql), score
+    if best is None:
+        return None
+    ex, sql = best
+    if sql is None:
+        return dspy.Prediction(intent=ex.intent, sql=ex.sql, params=None)
+    # DuckDB rejects named parameters the query does not use
+    params = {k: v for k, v in _date_params(date_filter).items() if re.search(rf"\${k}\b", sql)}
+    return dspy.Prediction(intent=ex.intent, sql=sql, params=params)
 
 # Keep trainset/optimized_planner.json usage as in repo
-def get_optimized_planner():
+PLANNER_PATH = "optimized_planner.json"
+PLANNER_HASH_PATH = "optimized_planner.sha1"  # trainset_hash() the JSON was compiled from
+
+def trainset_hash() -> str:
+    """Hash of what a compiled planner depends on: the trainset and IntentAndSQL's instructions."""
+    payload = repr((IntentAndSQL.instructions, [sorted(ex.toDict().items()) for ex in trainset]))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def compile_planner() -> SQLPlanner:
     """
-    Minimal: ensure LM configured (left to existing implementation).
-    This function returns a planner. For hotfix we rely on optimized_planner.json if present.
+    Compile SQLPlanner on trainset. The metric rejects every bootstrapped trace, so only the labeled
+    demos are kept (max_bootstrapped_demos=0): no LM calls, safe to run at startup.
     """
+    from dspy.teleprompt import BootstrapFewShot
+
+    teleprompter = BootstrapFewShot(
+        metric=lambda ex, pred, trace=None: 0.0,
+        max_bootstrapped_demos=0,
+        max_labeled_demos=5,
+    )
+    return teleprompter.compile(SQLPlanner(), trainset=trainset)
+
+def save_planner(planner: SQLPlanner, path: str = PLANNER_PATH) -> None:
+    """Write the planner JSON plus the trainset hash sidecar next to it."""
+    planner.save(path)
+    with open(os.path.join(os.path.dirname(path), PLANNER_HASH_PATH), "w") as f:
+        f.write(trainset_hash())
+
+def _stored_trainset_hash() -> Optional[str]:
     try:
-        import streamlit as st
-
-        @st.cache_resource
-        def _load_or_create():
-            json_path = "optimized_planner.json"
-            if os.path.exists(json_path):
-                try:
-                    planner = SQLPlanner()
-                    planner.load(json_path)
-                    logger.info("Loaded planner from optimized_planner.json")
-                    return planner
-                except Exception:
-                    logger.exception("Failed to load optimized_planner.json, falling back")
-            return SQLPlanner()
-
-        return _load_or_create()
-    except Exception:
-        # non-streamlit environment
-        json_path = "optimized_planner.json"
-        if os.path.exists(json_path):
-            try:
-                planner = SQLPlanner()
-                planner.load(json_path)
-                return planner
-            except Exception:
-                pass
-        return SQLPlanner()
+        with open(PLANNER_HASH_PATH) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=1)
+def load_planner() -> SQLPlanner:
+    """
+    Deserialize optimized_planner.json once per process. If it is missing or was compiled from a
+    different trainset (sidecar hash mismatch), recompile and try to save it; if it exists but
+    cannot be read (e.g. saved by another DSPy version), recompile in memory and leave it alone.
+    """
+    if os.path.exists(PLANNER_PATH) and _stored_trainset_hash() == trainset_hash():
+        try:
+            planner = SQLPlanner()
+            planner.load(PLANNER_PATH)
+            logger.info("Loaded planner from %s", PLANNER_PATH)
+            return planner
+        except Exception:
+            logger.exception("Failed to load %s, recompiling in memory", PLANNER_PATH)
+            return compile_planner()
+    logger.warning(
+        "%s missing or stale for the current trainset; recompiling from labeled demos "
+        "(no LM calls). Run compile_app.py and commit the JSON + %s to skip this.",
+        PLANNER_PATH, PLANNER_HASH_PATH,
+    )
+    planner = compile_planner()
+    try:
+        save_planner(planner)
+    except OSError:
+        logger.warning("Could not save recompiled planner to %s", PLANNER_PATH)
+    return planner
+
+def get_optimized_planner():
+    """Return the process-wide planner (kept for app.py / older callers)."""
+    return load_planner()
+
+# ---------- LM ----------
+LM_MODEL = "gemini/gemini-2.5-flash"
+# Intent + SQL from labeled demos / templates is the easier task: route it to the cheaper, faster tier
+# (set PLANNER_MODEL=gemini/gemini-2.5-flash to go back if generated SQL regresses)
+PLANNER_MODEL = os.environ.get("PLANNER_MODEL", "gemini/gemini-2.5-flash-lite")
+LM_NUM_RETRIES = 5  # litellm retries 429/transient errors with exponential backoff
+LM_MAX_CONCURRENCY = 4  # in-flight Gemini calls per process (free tier is ~5-15 RPM)
+_LM_LOCK = threading.Lock()
+_LMS: Dict[str, List["dspy.LM"]] = {}  # model -> one LM per API key
+_LM_TURN = 0
+_LM_SLOTS = threading.BoundedSemaphore(LM_MAX_CONCURRENCY)
+
+def lm_api_keys() -> List[Optional[str]]:
+    """
+    Gemini keys to spread calls over: GEMINI_API_KEYS (comma-separated) or GEMINI_KEY_1..N.
+    Free-tier limits are per Google Cloud project, so keys from different projects add up.
+    [None] means a single LM that lets litellm read GEMINI_API_KEY itself.
+    """
+    keys = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()]
+    if not keys:
+        i = 1
+        while os.environ.get(f"GEMINI_KEY_{i}"):
+            keys.append(os.environ[f"GEMINI_KEY_{i}"])
+            i += 1
+    return keys or [None]
+
+def get_lm(model: str = LM_MODEL) -> "dspy.LM":
+    """
+    Process-wide DSPy LM for `model`, built once with the settings compile_app.py compiles the planner with.
+    With several API keys there is one LM per key and successive calls take turns (round-robin).
+    Outside the main thread dspy.configure() only sets a per-thread override, and Streamlit runs
+    every script in a worker thread, so callers bind it per call with dspy.context(lm=get_lm()).
+    """
+    global _LM_TURN
+    with _LM_LOCK:
+        if model not in _LMS:
+            _LMS[model] = [
+                dspy.LM(
+                    model, max_tokens=2000, temperature=0.1, top_p=0.95,
+                    num_retries=LM_NUM_RETRIES, cache=True,  # identical prompts are served from DSPY_CACHEDIR
+                    **({"api_key": key} if key else {}),
+                )
+                for key in lm_api_keys()
+            ]
+        lms = _LMS[model]
+        lm = lms[_LM_TURN % len(lms)]
+        _LM_TURN += 1
+        return lm
 
 # ---------- Lazy DB initialization ----------
+_DB_INIT_LOCK = threading.Lock()
+_DB_READY = False  # set once the file is checked/built, so later questions skip the probe queries
+
 def ensure_database_exists():
-    """Create DB from CSV only when needed (lazy)."""
+    """Create DB from CSV only when needed (lazy, once per process)."""
+    global _DB_READY
+    if _DB_READY:
+        return
+    # serialize: app.py warms this up in a background thread while a submit may also call it
+    with _DB_INIT_LOCK:
+        if not _DB_READY:
+            _ensure_database_exists()
+            _DB_READY = True
+
+def _ensure_database_exists():
     if not os.path.exists(DB_PATH):
         logger.info("Creating DB because it does not exist: %s", DB_PATH)
         from init_db import init_database
         init_database(DB_PATH)
     else:
-        # quick check DB health
+        from init_db import WIDE_TABLES
+
+        # quick check DB health (through the shared connection: a second connect to the same file
+        # with a different configuration would fail even when the DB is fine)
         try:
-            con = duckdb.connect(DB_PATH, read_only=True)
+            con = get_connection().cursor()
             con.execute("SELECT 1").fetchone()
+            # the planner prompt names the wide tables; DB files built before them are rebuilt
+            for table_name in WIDE_TABLES:
+                con.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchall()
             con.close()
         except Exception:
-            logger.warning("DB file exists but cannot be opened; recreating.")
+            logger.warning("DB file exists but is unreadable or outdated; recreating.")
+            _close_connection()
             try:
                 os.remove(DB_PATH)
             except Exception:
@@ -147,40 +581,171 @@ def ensure_database_exists():
             init_database(DB_PATH)
 
 # ---------- Simple table extractor ----------
+_CTE_RE = re.compile(r"(?:\bWITH|,)\s*([A-Za-z_][A-Za-z0-9_]*)\s+AS\s*\(", re.IGNORECASE)
+
 def extract_tables_from_sql(sql: str) -> List[str]:
     pattern = r"(?:FROM|JOIN)\s+([A-Za-z0-9_\.]+)"
-    return [m.group(1) for m in re.finditer(pattern, sql, flags=re.IGNORECASE)]
+    ctes = {m.group(1).lower() for m in _CTE_RE.finditer(sql)}  # WITH names are not DB tables
+    return [m.group(1) for m in re.finditer(pattern, sql, flags=re.IGNORECASE) if m.group(1).lower() not in ctes]
 
-# ---------- Main function used by app.py ----------
-def ask_bot_core(question: str) -> Dict[str, Any]:
+# ---------- Insight ----------
+INSIGHT_ROWS = 20  # rows of the result sent to the insight LM
+INSIGHT_MAX_TOKENS = 512  # the capped fields fit well inside this; the planner keeps the LM's 2000
+
+def _compact_records(df: "pd.DataFrame") -> str:
     """
-    Minimal contract:
-      returns dict with keys: question, intent, sql, table_view, kpi_summary, explanation, action
-      If SQL/table problem: return sql_error=True and helpful fields
+    Column names once + row arrays (orient="split"). Per-row records repeat every key and came out
+    ~1.6-1.9x longer than the markdown table on this datamart; split is slightly shorter than it.
+    When rows are cut, total_rows and column_sums (numeric columns over all rows) say what the head leaves out.
     """
-    if not question or not question.strip():
-        raise ValueError("Empty question")
+    import pandas as pd
 
-    # Lazy initialize DB when first asked
-    ensure_database_exists()
+    head = df.head(INSIGHT_ROWS).dropna(axis=1, how="all").round(2)
+    table_json = head.to_json(orient="split", index=False, force_ascii=False, date_format="iso")
+    if len(df) <= INSIGHT_ROWS:
+        return table_json
+    numeric = [c for c in head.columns if pd.api.types.is_numeric_dtype(df[c])]
+    sums = pd.Series({c: df[c].sum() for c in numeric}, dtype="float64").round(2)
+    footer = f',"total_rows":{len(df)},"column_sums":{sums.to_json(force_ascii=False)}}}'
+    return table_json[:-1] + footer
+
+@functools.lru_cache(maxsize=1)
+def _insight_predictor() -> "dspy.Predict":
+    return dspy.Predict(InsightFromResult, max_tokens=INSIGHT_MAX_TOKENS)
 
-    # Get planner (may configure LM as side-effect)
+# A single value, or a top-N list of exactly this many rows, is read straight back to the user;
+# other tables (including 2-row comparisons) go to Gemini
+DIRECT_TOP_N = 3
+# The outermost ORDER BY <column> [ASC|DESC] ... LIMIT n of a query
+_TOP_N_RE = re.compile(
+    r"\bORDER\s+BY\s+([\w\".]+)(?:\s+(ASC|DESC))?[^()]*?\bLIMIT\s+\d+[\s;]*\Z", re.IGNORECASE
+)
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return f"{value:,.0f}" if float(value).is_integer() else f"{value:,.2f}"
+    return str(value)
+
+def _is_top_n(sql: str, value_col: str) -> Optional[bool]:
+    """True/False (descending or not) when sql ends in ORDER BY value_col ... LIMIT, else None."""
+    m = _TOP_N_RE.search(sql)
+    if not m:
+        return None
+    order_col = m.group(1).split(".")[-1].strip('"').lower()
+    if order_col not in (str(value_col).lower(), "2"):
+        return None
+    return (m.group(2) or "").upper() == "DESC"
+
+def _direct_insight(df: "pd.DataFrame", sql: str = "") -> Optional[Tuple[str, str, str]]:
+    """
+    Deterministic (kpi_summary, explanation, action) for a 1x1 result, or for DIRECT_TOP_N (label, value)
+    rows from SQL that orders by that value and LIMITs (a top-N answer); None when the table needs the insight LM.
+    """
+    import pandas as pd
+
+    if df.isna().any(axis=None):
+        return None
+    rows = df.astype(object).values.tolist()
+    if df.shape == (1, 1):
+        col, value = df.columns[0], _format_value(rows[0][0])
+        kpi_summary = f"- **{col}:** {value}"
+        explanation = f"ผลลัพธ์เป็นค่าเดียว: {col} = {value}"
+        action = f"ถามต่อโดยแยก {col} ตามสาขา / รุ่น หรือเทียบกับเดือนก่อน เพื่อดูว่าตัวเลขนี้มาจากไหน"
+        return kpi_summary, explanation, action
+    if df.shape != (DIRECT_TOP_N, 2) or not pd.api.types.is_numeric_dtype(df.iloc[:, 1]):
+        return None
+    label, value = df.columns
+    descending = _is_top_n(sql, value)
+    if descending is None:
+        return None  # a breakdown that happens to be short, not a ranking
+    order = "มากไปน้อย" if descending else "น้อยไปมาก"
+    kpi_summary = "\n".join(f"{i}. {r[0]} — {value}: {_format_value(r[1])}" for i, r in enumerate(rows, 1))
+    explanation = f"{len(df)} อันดับแรกของ {label} เรียงตาม {value} จาก{order}"
+    action = (
+        f"เทียบ {rows[0][0]} ({_format_value(rows[0][1])}) กับ {rows[-1][0]} ({_format_value(rows[-1][1])}) "
+        f"เพื่อหาสาเหตุที่ {value} ต่างกัน"
+    )
+    return kpi_summary, explanation, action
+
+INSIGHT_CACHE_SIZE = 256
+# sha256 of the compact result JSON -> (kpi_summary, explanation, action): differently worded questions
+# often land on the same standard-KPI table, and the insight is written from the table
+_INSIGHT_CACHE: "OrderedDict[str, Tuple[str, str, str]]" = OrderedDict()
+_INSIGHT_CACHE_LOCK = threading.Lock()
+
+def generate_insight(question: str, df: "pd.DataFrame", sql: str = "") -> Tuple[str, str, str]:
+    """(kpi_summary, explanation, action) for a non-empty result of `sql`."""
+    direct = _direct_insight(df, sql)
+    if direct is not None:
+        return direct
+    table_json = _compact_records(df)
+    key = hashlib.sha256(table_json.encode("utf-8")).hexdigest()
+    with _INSIGHT_CACHE_LOCK:
+        hit = _INSIGHT_CACHE.get(key)
+        if hit is not None:
+            _INSIGHT_CACHE.move_to_end(key)
+            return hit
+    with _LM_SLOTS, dspy.context(lm=get_lm()):
+        pred = _insight_predictor()(question=question, table_json=table_json)
+    insight = (pred.kpi_summary, pred.explanation, pred.action)
+    with _INSIGHT_CACHE_LOCK:
+        _INSIGHT_CACHE[key] = insight
+        while len(_INSIGHT_CACHE) > INSIGHT_CACHE_SIZE:
+            _INSIGHT_CACHE.popitem(last=False)
+    return insight
+
+# ---------- Main functions used by app.py ----------
+_PLANNER_POOL = ThreadPoolExecutor(max_workers=LM_MAX_CONCURRENCY, thread_name_prefix="planner")
+
+def plan_cache_path() -> str:
+    """One file per (PLANNER_MODEL, trainset_hash()): changing either starts from an empty plan cache."""
+    tag = hashlib.sha1(f"{PLANNER_MODEL}\0{trainset_hash()}".encode("utf-8")).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"plancache_{tag}.pkl")
+
+@functools.lru_cache(maxsize=1)
+def _plan_cache() -> SemanticCache:
+    """question -> (intent, sql), matched like app.py's answer cache but kept apart from the insight."""
+    return SemanticCache(path=plan_cache_path())
+
+def _plan(question: str) -> Tuple[Any, bool]:
+    """
+    (plan, whether it came from the LM planner). Runs on _PLANNER_POOL, so the LM is bound here
+    (dspy.context is per-thread). Planner output is cached by the caller once its SQL has run.
+    """
+    template = match_template(question)
+    if template is not None:
+        return template, False
+    cached = _plan_cache().get(question)
+    if cached is not None:
+        intent, sql = cached
+        return dspy.Prediction(intent=intent, sql=sql), False
     planner = get_optimized_planner()
+    with _LM_SLOTS, dspy.context(lm=get_lm(PLANNER_MODEL)):
+        return planner(question), True
 
-    # Call planner to get SQL (keep max_retries simple)
-    try:
-        plan = planner(question)
-    except Exception as e:
-        # Let higher layer handle LM-init errors (app.py catches AssertionError etc.)
-        raise
+def ask_bot_core_stream(question: str) -> Iterator[Tuple[str, Any]]:
+    """
+    Streaming form of ask_bot_core: yields (field, value) pairs as soon as each one is known,
+    so the UI can show intent/SQL while the query runs. dict() of the stream equals ask_bot_core().
+    """
+    if not question or not question.strip():
+        raise ValueError("Empty question")
+    yield "question", question
+
+    # Plan on a worker thread (a Gemini round-trip) while this thread opens the DB and lists its
+    # tables for the pre-validation below; the two used to run back to back
+    plan_future = _PLANNER_POOL.submit(_plan, question)
+    ensure_database_exists()
+    available = _list_tables()
+    # Let higher layer handle LM-init errors (app.py catches AssertionError etc.)
+    plan, planned = plan_future.result()
 
     # Validate plan
     raw_sql = getattr(plan, "sql", "") if plan else ""
     intent = getattr(plan, "intent", "") if plan else ""
+    yield "intent", intent
     if not raw_sql:
-        return {
-            "question": question,
-            "intent": intent,
+        yield from {
             "sql": "",
             "table_view": "",
             "kpi_summary": "",
@@ -188,21 +753,24 @@ def ask_bot_core(question: str) -> Dict[str, Any]:
             "action": "ลองถามใหม่หรือตรวจสอบการตั้งค่า planner",
             "sql_error": True,
             "sql_error_message": "Missing SQL in planner response",
-            "sql_error_available_tables": _list_tables(),
-        }
+            "sql_error_available_tables": available,
+        }.items()
+        return
 
     sql = clean_sql(raw_sql)
+    params = getattr(plan, "params", None)
+    if params:
+        # show the values bound to the template's $parameters alongside it
+        yield "sql", "-- " + ", ".join(f"${k} = {v}" for k, v in params.items()) + "\n" + sql
+    else:
+        yield "sql", sql
 
     # Pre-validate: check tables mentioned in SQL exist in DB
     mentioned = [t.split(".")[-1] for t in extract_tables_from_sql(sql)]
-    available = _list_tables()
     missing = [t for t in mentioned if t and t not in available]
     if missing:
         # do NOT run SQL; return friendly structured error
-        return {
-            "question": question,
-            "intent": intent,
-            "sql": sql,
+        yield from {
             "table_view": "",
             "kpi_summary": "",
             "explanation": f"SQL อ้างถึงตารางที่ไม่มีในฐานข้อมูล: {', '.join(missing)}",
@@ -210,16 +778,14 @@ def ask_bot_core(question: str) -> Dict[str, Any]:
             "sql_error": True,
             "sql_error_message": f"Missing tables: {missing}",
             "sql_error_available_tables": available,
-        }
+        }.items()
+        return
 
     # Run SQL (catch SQLExecutionError)
     try:
-        df, table_view = run_sql(sql)
+        df, table_view = run_sql(sql, params=params)
     except SQLExecutionError as se:
-        return {
-            "question": question,
-            "intent": intent,
-            "sql": sql,
+        yield from {
             "table_view": "",
             "kpi_summary": "",
             "explanation": f"เกิดข้อผิดพลาดขณะรัน SQL: {se.message}",
@@ -227,40 +793,101 @@ def ask_bot_core(question: str) -> Dict[str, Any]:
             "sql_error": True,
             "sql_error_message": se.message,
             "sql_error_available_tables": se.available_tables,
-        }
+        }.items()
+        return
+    if planned:
+        # only SQL that ran is replayed for later rewordings; a failed plan goes back to the LM next time
+        _plan_cache().put(question, (intent, raw_sql))
+    yield "table", df
+    yield "table_view", table_view
 
     # If no rows -> graceful
     if df.empty:
-        return {
-            "question": question,
-            "intent": intent,
-            "sql": sql,
-            "table_view": table_view,
+        yield from {
             "kpi_summary": "",
             "explanation": "ไม่พบข้อมูลในเงื่อนไขนี้",
             "action": "ลองเปลี่ยนเดือน / ปี หรือเงื่อนไขดูอีกครั้ง",
             "sql_error": False,
-        }
+        }.items()
+        return
 
-    # Insight generation (keep original behavior)
+    # Insight generation: a failure here still leaves the SQL result on screen
     try:
-        predictor = dspy.Predict  # assume signature exists; keep generic
-        # For simplicity, not calling insight predictor in this minimal hotfix
-        kpi_summary = ""
-        explanation = ""
-        action = ""
+        kpi_summary, explanation, action = generate_insight(question, df, sql)
     except Exception:
+        logger.exception("Insight generation failed")
         kpi_summary = ""
         explanation = ""
         action = ""
 
-    return {
-        "question": question,
-        "intent": intent,
-        "sql": sql,
-        "table_view": table_view,
-        "kpi_summary": kpi_summary,
-        "explanation": explanation,
-        "action": action,
-        "sql_error": False,
-    }
+    yield "kpi_summary", kpi_summary
+    yield "explanation", explanation
+    yield "action", action
+    yield "sql_error", False
+
+def ask_bot_core(question: str) -> Dict[str, Any]:
+    """
+    Minimal contract:
+      returns dict with keys: question, intent, sql, table_view, kpi_summary, explanation, action
+      (plus `table`, the result DataFrame, when the SQL ran)
+      If SQL/table problem: return sql_error=True and helpful fields
+    """
+    return dict(ask_bot_core_stream(question))
+
+async def ask_bot_core_async(question: str) -> Dict[str, Any]:
+    """
+    ask_bot_core for asyncio callers (e.g. an async web endpoint): the pipeline runs on a worker
+    thread, so the event loop keeps serving other requests during the Gemini round-trips.
+    """
+    return await asyncio.to_thread(ask_bot_core, question)
+
+def ask_bot_batch(questions: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    ask_bot_core for several questions at once, in order: duplicates (same normalize_question key)
+    are answered once and the rest run concurrently (LM calls still bounded by _LM_SLOTS).
+    A question whose pipeline raises gets None.
+    """
+    unique: Dict[str, str] = {}
+    for q in questions:
+        unique.setdefault(normalize_question(q), q)
+    if not unique:
+        return []
+
+    def _safe_ask(q: str) -> Optional[Dict[str, Any]]:
+        try:
+            return ask_bot_core(q)
+        except Exception:
+            logger.exception("Batch question failed: %s", q)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(LM_MAX_CONCURRENCY, len(unique))) as ex:
+        answers = dict(zip(unique, ex.map(_safe_ask, unique.values())))
+    return [answers[normalize_question(q)] for q in questions]
+
+# ---------- Warm-up ----------
+LM_WARMUP = os.environ.get("LM_WARMUP", "1") == "1"  # set LM_WARMUP=0 to skip the ping below
+_WARM_UP_LOCK = threading.Lock()
+_LMS_PINGED = False  # the pings run once per process; app.py calls warm_up() from every new session
+
+def warm_up() -> None:
+    """
+    Pay the cold-start costs before the first question: open the DB, load the planner, build the LM(s)
+    and, with LM_WARMUP on, send each LM a tiny uncached request so litellm's HTTPS connection is already open.
+    """
+    global _LMS_PINGED
+    ensure_database_exists()
+    get_optimized_planner()
+    get_lm(PLANNER_MODEL)  # same Gemini host as LM_MODEL, so the pings below warm its connection too
+    with _WARM_UP_LOCK:
+        if _LMS_PINGED:
+            return
+        _LMS_PINGED = True
+    for _ in lm_api_keys():
+        lm = get_lm()
+        if LM_WARMUP:
+            try:
+                # cache=False: a ping answered from dspy's disk cache opens no connection
+                with _LM_SLOTS:
+                    lm("ping", max_tokens=16, cache=False)
+            except Exception:
+                logger.debug("LM warm-up ping failed", exc_info=True)
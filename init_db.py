@@ -7,6 +7,31 @@ import os
 from pathlib import Path
 
 
+# Denormalized copies of the fact tables (fact columns + date/branch/product attributes)
+WIDE_TABLES = {
+    "fact_contract_wide": "fact_contract",
+    "fact_registration_wide": "fact_registration",
+    "fact_inventory_wide": "fact_inventory_snapshot",
+}
+
+WIDE_TABLE_SQL = """
+CREATE OR REPLACE TABLE {table} AS
+SELECT
+    f.*,
+    d.date, d.year, d.month, d.day,
+    b.branch_code, b.branch_name, b.branch_type, b.province,
+    p.model_name, p.generation, p.storage_gb, p.color, p.base_price
+FROM {fact} f
+JOIN dim_date d USING (date_key)
+JOIN dim_branch b USING (branch_id)
+JOIN dim_product p USING (product_id)
+ORDER BY f.date_key, f.branch_id
+"""
+
+# Fact tables are stored sorted by date so DuckDB's per-row-group min/max can skip blocks on date_key filters
+FACT_ORDER_BY = " ORDER BY date_key, branch_id"
+
+
 def init_database(db_path: str = "iphone_gold.duckdb", force_recreate: bool = False):
     """
     Initialize DuckDB database from CSV files.
@@ -25,6 +50,9 @@ def init_database(db_path: str = "iphone_gold.duckdb", force_recreate: bool = Fa
             con = duckdb.connect(db_path, read_only=True)
             # Test if we can query the database
             con.execute("SELECT COUNT(*) FROM dim_product").fetchone()
+            # Databases built before the wide tables existed are rebuilt
+            for table_name in WIDE_TABLES:
+                con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()
             con.close()
             print(f"✅ Database already exists and is valid: {db_path}")
             return False
@@ -82,7 +110,8 @@ def init_database(db_path: str = "iphone_gold.duckdb", force_recreate: bool = Fa
                 df = df.drop_duplicates()
                 
                 # Create table from dataframe
-                con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM df")
+                order_by = FACT_ORDER_BY if table_name.startswith("fact_") else ""
+                con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM df{order_by}")
                 
                 row_count = con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
                 print(f"    ✓ Loaded {row_count} rows")
@@ -99,10 +128,16 @@ def init_database(db_path: str = "iphone_gold.duckdb", force_recreate: bool = Fa
                 )
                 df.columns = df.columns.str.strip()
                 df = df.drop_duplicates()
-                con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM df")
+                order_by = FACT_ORDER_BY if table_name.startswith("fact_") else ""
+                con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM df{order_by}")
                 row_count = con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
                 print(f"    ✓ Loaded {row_count} rows (with latin1)")
         
+        # Pre-join each fact table with its dimensions once, so planner SQL can skip the JOINs
+        for table_name, fact in WIDE_TABLES.items():
+            print(f"  🧱 Building {table_name}...")
+            con.execute(WIDE_TABLE_SQL.format(table=table_name, fact=fact))
+
         # Verify all tables
         print("\n✅ Database created successfully!")
         print("📊 Table summary:")
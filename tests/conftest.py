@@ -0,0 +1,8 @@
+# tests/conftest.py
+# Make the app modules (core.py, cache.py, ...) importable from the repo root
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
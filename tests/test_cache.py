@@ -0,0 +1,80 @@
+# tests/test_cache.py
+# SemanticCache must hit on rewordings but never on questions that ask for something else
+
+import threading
+import time
+
+import pytest
+
+from cache import HISTORICAL_TTL, SemanticCache, SingleFlight, cosine, key_terms, ngram_vector, ttl_for
+
+HIGHEST = "วันที่ 11/11/2025 สาขาไหนเสียโอกาสขาย (Demand > Stock) สูงที่สุด?"
+LOWEST = "วันที่ 11/11/2025 สาขาไหนเสียโอกาสขาย (Demand > Stock) ต่ำที่สุด?"
+PRO = "เดือน 11 ปี 2025 ยอดจอง iPhone 16 Pro แต่ละสาขาเป็นเท่าไหร่?"
+PRO_MAX = "เดือน 11 ปี 2025 ยอดจอง iPhone 16 Pro Max แต่ละสาขาเป็นเท่าไหร่?"
+
+@pytest.fixture
+def cache(tmp_path):
+    return SemanticCache(path=str(tmp_path / "semcache.pkl"))
+
+def test_hits_on_trivial_rewording(cache):
+    cache.put(HIGHEST, "answer")
+    assert cache.get("  วันที่ ๑๑/๑๑/๒๐๒๕ สาขาไหนเสียโอกาสขาย (demand > stock) สูงที่สุด？") == "answer"
+    assert cache.get(HIGHEST.replace("สูงที่สุด", "สูงสุด")) == "answer"
+
+@pytest.mark.parametrize("cached, asked", [(HIGHEST, LOWEST), (PRO, PRO_MAX), (PRO_MAX, PRO)])
+def test_misses_on_different_key_terms(cache, cached, asked):
+    # similar enough for the n-gram cutoff on its own ...
+    assert cosine(ngram_vector(cached), ngram_vector(asked)) >= cache.cutoff
+    # ... but asking for the other end of the ranking / another model
+    assert key_terms(cached) != key_terms(asked)
+    cache.put(cached, "answer")
+    assert cache.get(asked) is None
+
+def test_misses_on_different_numbers(cache):
+    cache.put(PRO, "answer")
+    assert cache.get(PRO.replace("เดือน 11", "เดือน 10")) is None
+
+def test_table_is_not_persisted(tmp_path):
+    path = str(tmp_path / "semcache.pkl")
+    SemanticCache(path=path).put(HIGHEST, {"sql": "SELECT 1", "table": object()})
+    assert SemanticCache(path=path).get(HIGHEST) == {"sql": "SELECT 1"}
+
+@pytest.mark.parametrize("year", ["2020", "๒๐๒๐", "2563"])
+def test_past_years_get_the_historical_ttl(year):
+    assert ttl_for(f"ยอดขายปี {year} เป็นเท่าไหร่?") == HISTORICAL_TTL
+
+def test_single_flight_keeps_control_flow_exceptions_in_the_leader():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def leader_fn():
+        started.set()
+        release.wait()
+        raise KeyboardInterrupt  # stands in for Streamlit's RerunException
+
+    def leader():
+        try:
+            flight.do("q", leader_fn)
+        except KeyboardInterrupt:
+            results.append("leader interrupted")
+
+    def follower():
+        results.append(flight.do("q", lambda: "answer"))
+
+    t1 = threading.Thread(target=leader)
+    t1.start()
+    started.wait()
+    t2 = threading.Thread(target=follower)
+    t2.start()
+    time.sleep(0.05)  # let the follower block on the leader's future
+    release.set()
+    t1.join()
+    t2.join()
+    assert sorted(results) == ["answer", "leader interrupted"]
+
+def test_peek_does_not_count(cache):
+    cache.put(HIGHEST, "answer")
+    assert cache.peek(HIGHEST) == "answer" and cache.peek(LOWEST) is None
+    assert cache.hits == cache.misses == 0
@@ -0,0 +1,37 @@
+# tests/test_direct_insight.py
+# Only a single value or an explicit top-N query skips the insight LM
+
+import pandas as pd
+
+import core
+
+TOP_3_SQL = """
+    SELECT branch_name, SUM(contract_count) AS sales
+    FROM fact_contract_wide
+    GROUP BY branch_name
+    ORDER BY sales DESC
+    LIMIT 3;
+"""
+
+def test_single_value():
+    kpi_summary, explanation, _ = core._direct_insight(pd.DataFrame({"total": [4920]}))
+    assert "4,920" in kpi_summary and "total" in explanation
+
+def test_top_n_query_is_a_ranking():
+    df = pd.DataFrame({"branch_name": ["A", "B", "C"], "sales": [30, 20, 10]})
+    kpi_summary, explanation, _ = core._direct_insight(df, TOP_3_SQL)
+    assert kpi_summary.startswith("1. A") and "มากไปน้อย" in explanation
+
+def test_two_rows_go_to_the_lm():
+    df = pd.DataFrame({"generation": ["iPhone 15", "iPhone 16"], "total_reg": [120, 340]})
+    assert core._direct_insight(df, TOP_3_SQL.replace("sales", "total_reg")) is None
+    assert core._direct_insight(df, "SELECT generation, SUM(reg_count) AS total_reg FROM t GROUP BY 1") is None
+
+def test_sorted_breakdown_without_limit_goes_to_the_lm():
+    df = pd.DataFrame({"month": [9, 10, 11], "sales": [10, 20, 30]})
+    assert core._direct_insight(df, "SELECT month, SUM(c) AS sales FROM t GROUP BY month ORDER BY month") is None
+    assert core._direct_insight(df, "SELECT month, SUM(c) AS sales FROM t GROUP BY month ORDER BY month LIMIT 3") is None
+
+def test_wider_results_go_to_the_lm():
+    assert core._direct_insight(pd.DataFrame({"total": [1], "n": [2]})) is None
+    assert core._direct_insight(pd.DataFrame({"a": list("abcd"), "n": [4, 3, 2, 1]}), TOP_3_SQL) is None
@@ -0,0 +1,16 @@
+# tests/test_run_sql.py
+# run_sql's per-process result cache must not serve clock-dependent SQL
+
+import core
+
+def test_plain_sql_is_cached():
+    core.ensure_database_exists()  # the cache is keyed on the DB file's mtime
+    first, _ = core.run_sql("SELECT 42 AS answer")
+    second, _ = core.run_sql("SELECT 42 AS answer")
+    assert second is first
+
+def test_clock_dependent_sql_is_not_cached():
+    for sql in ("SELECT CURRENT_DATE AS d", "SELECT now() AS t", "SELECT today() AS d"):
+        first, _ = core.run_sql(sql)
+        second, _ = core.run_sql(sql)
+        assert second is not first
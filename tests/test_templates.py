@@ -0,0 +1,38 @@
+# tests/test_templates.py
+# The template shortcut answers without the LM, so it must only fire on true rewordings of an example
+
+import pytest
+
+import core
+from trainset import ex1, ex2
+
+def test_every_example_matches_itself():
+    for ex in core.trainset:
+        plan = core.match_template(ex.question)
+        assert plan is not None and plan.intent == ex.intent
+
+def test_other_month_binds_parameters():
+    plan = core.match_template(ex2.question.replace("เดือน 11 ปี 2025", "พ.ย. 2568"))
+    assert plan.intent == ex2.intent
+    assert plan.params == {"month_start": 20251101, "next_month_start": 20251201}
+    plan = core.match_template(ex2.question.replace("เดือน 11", "เดือน 10"))
+    assert plan.params == {"month_start": 20251001, "next_month_start": 20251101}
+    assert "$month_start" in plan.sql and "20251101" not in plan.sql
+
+def test_other_day_binds_parameters():
+    plan = core.match_template(ex1.question.replace("11/11/2025", "12/11/2025"))
+    assert plan.intent == ex1.intent and plan.params == {"date_key": 20251112}
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        # per-branch breakdown, not ex2's per-model one
+        ex2.question.replace("เดือน 11", "เดือน 10").replace("แต่ละรุ่น", "แต่ละสาขา"),
+        # the lowest, not ex1's highest
+        ex1.question.replace("สูงที่สุด", "ต่ำที่สุด"),
+        # another model tier
+        ex2.question.replace("iPhone", "iPhone Pro Max"),
+    ],
+)
+def test_near_miss_questions_go_to_the_planner(question):
+    assert core.match_template(question) is None
@@ -0,0 +1,155 @@
+# trainset.py
+# Labeled planner examples: the single source for core.py (compile, demos, SQL templates) and compile_app.py
+
+import dspy
+
+ex1 = dspy.Example(
+    question="วันที่ 11/11/2025 สาขาไหนเสียโอกาสขาย (Demand > Stock) สูงที่สุด?",
+    intent="lost_opportunity_by_branch_on_date",
+    sql="""
+        SELECT
+            b.branch_code,
+            b.branch_name,
+            SUM(r.reg_count) AS demand,
+            SUM(i.stock_qty) AS stock,
+            SUM(r.reg_count) - SUM(i.stock_qty) AS lost_opportunity
+        FROM fact_registration r
+        JOIN fact_inventory_snapshot i
+          ON r.date_key   = i.date_key
+         AND r.branch_id  = i.branch_id
+         AND r.product_id = i.product_id
+        JOIN dim_branch b ON r.branch_id = b.branch_id
+        WHERE r.date_key = 20251111
+        GROUP BY b.branch_code, b.branch_name
+        HAVING SUM(r.reg_count) > SUM(i.stock_qty)
+        ORDER BY lost_opportunity DESC;
+    """,
+).with_inputs("question")
+
+ex2 = dspy.Example(
+    question="เดือน 11 ปี 2025 ลูกค้าสนใจ iPhone แต่ละรุ่น (จาก Registration) เท่าไหร่?",
+    intent="demand_by_generation_mtd",
+    sql="""
+        SELECT
+            p.generation AS iphone_gen,
+            SUM(r.reg_count) AS total_reg
+        FROM fact_registration r
+        JOIN dim_product p ON r.product_id = p.product_id
+        WHERE r.date_key >= 20251101
+          AND r.date_key <  20251201
+        GROUP BY p.generation
+        ORDER BY total_reg DESC;
+    """,
+).with_inputs("question")
+
+ex3 = dspy.Example(
+    question="ในเดือนพฤศจิกายน 2025 สาขาไหนมียอดขายเครื่องมากที่สุด?",
+    intent="best_branch_mtd",
+    sql="""
+        SELECT
+            b.branch_code,
+            b.branch_name,
+            SUM(c.contract_count) AS total_units_sold
+        FROM fact_contract c
+        JOIN dim_branch b ON c.branch_id = b.branch_id
+        WHERE c.date_key >= 20251101
+          AND c.date_key <  20251201
+        GROUP BY b.branch_code, b.branch_name
+        ORDER BY total_units_sold DESC;
+    """,
+).with_inputs("question")
+
+ex4 = dspy.Example(
+    question="สาขาไหนมี conversion rate ดีที่สุด และสาขาไหนควรปรับปรุง?",
+    intent="branch_conversion_performance",
+    sql="""
+        WITH recent_7days AS (
+            SELECT MAX(date_key) - 6 as start_date
+            FROM fact_registration
+        ),
+        shops AS (
+            SELECT branch_id, branch_code, branch_name, province
+            FROM dim_branch
+            WHERE branch_type = 'SHOP'
+        ),
+        branch_perf AS (
+            SELECT
+                b.branch_code,
+                b.branch_name,
+                b.province,
+                SUM(r.reg_count) AS total_registrations,
+                SUM(COALESCE(c.contract_count, 0)) AS total_contracts,
+                CASE 
+                    WHEN SUM(r.reg_count) = 0 THEN 0
+                    ELSE ROUND(SUM(COALESCE(c.contract_count, 0)) * 100.0 / SUM(r.reg_count), 1)
+                END AS conversion_rate,
+                SUM(COALESCE(c.contract_count, 0) * p.base_price) AS total_revenue
+            FROM shops b
+            JOIN fact_registration r ON r.branch_id = b.branch_id
+            CROSS JOIN recent_7days rd
+            LEFT JOIN fact_contract c 
+                ON r.date_key = c.date_key 
+                AND r.branch_id = c.branch_id 
+                AND r.product_id = c.product_id
+            LEFT JOIN dim_product p ON r.product_id = p.product_id
+            WHERE r.date_key >= rd.start_date
+            GROUP BY b.branch_code, b.branch_name, b.province
+        )
+        SELECT
+            branch_code,
+            branch_name,
+            province,
+            total_registrations,
+            total_contracts,
+            conversion_rate,
+            total_revenue,
+            CASE
+                WHEN conversion_rate >= 60 THEN 'EXCELLENT'
+                WHEN conversion_rate >= 50 THEN 'GOOD'
+                WHEN conversion_rate >= 40 THEN 'AVERAGE'
+                ELSE 'NEEDS_IMPROVEMENT'
+            END AS performance_tier
+        FROM branch_perf
+        ORDER BY conversion_rate DESC;
+    """,
+).with_inputs("question")
+
+ex5 = dspy.Example(
+    question="เดือน 11 ปี 2025 เทียบกับเดือน 10 ปี 2025 ยอดขายเป็นเงินรวมเป็นยังไง?",
+    intent="monthly_revenue_vs_prev_month",
+    sql="""
+        WITH monthly_revenue AS (
+            SELECT
+                d.year,
+                d.month,
+                SUM(c.contract_count * p.base_price) AS total_revenue
+            FROM fact_contract c
+            JOIN dim_date d    ON c.date_key   = d.date_key
+            JOIN dim_product p ON c.product_id = p.product_id
+            WHERE d.year = 2025
+              AND d.month IN (10, 11)
+            GROUP BY d.year, d.month
+        )
+        SELECT
+            cur.year,
+            cur.month           AS current_month,
+            cur.total_revenue   AS current_revenue,
+            prev.month          AS prev_month,
+            prev.total_revenue  AS prev_revenue,
+            cur.total_revenue - prev.total_revenue AS diff_revenue,
+            CASE
+                WHEN prev.total_revenue = 0 THEN NULL
+                ELSE ROUND(
+                    (cur.total_revenue - prev.total_revenue) * 100.0 / prev.total_revenue,
+                    2
+                )
+            END AS growth_pct
+        FROM monthly_revenue cur
+        LEFT JOIN monthly_revenue prev
+          ON cur.year  = prev.year
+         AND cur.month = 11
+         AND prev.month = 10;
+    """,
+).with_inputs("question")
+
+trainset = [ex1, ex2, ex3, ex4, ex5]